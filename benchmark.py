@@ -0,0 +1,540 @@
+"""
+Copyright (c) 2024 Cisco and/or its affiliates.
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+               https://developer.cisco.com/docs/licenses
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Benchmarks of the report against a local fake ThousandEyes API, no account or token needed.
+# Usage: python3 benchmark.py [--latency MS] [--workers N] [--rate-limit N] [--page-size N] concurrency|suite|replay
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import main
+
+# Startup budget of main.py: milliseconds on top of starting the bare interpreter
+STARTUP_BUDGET_MS = 50
+
+# Modules main.py must not import before a command needs them
+LAZY_MODULES = ("requests", "numpy", "dotenv", "http.server", "sqlite3", "concurrent.futures")
+
+TEST_TYPES = ["agent-to-server", "http-server", "page-load", "dns-server", "dns-trace", "api",
+              "ftp-server", "sip-server", "web-transactions", "bgp", "agent-to-agent", "voice"]
+
+
+def build_account(test_count, agent_count=50, seed=1, config_agents=False, rounds=1):
+    """
+    Builds a synthetic account with tests, agents and test results
+    :param test_count:
+    :param agent_count:
+    :param seed:
+    :param config_agents: list the agents of each test in its config, like the test details of the API
+    :param rounds: test results per agent, later rounds carry network metrics like the API
+    :return: dict with tests, agents and results keyed by test id
+    """
+    rnd = random.Random(seed)
+    agents = []
+    for agent_id in range(1, agent_count + 1):
+        agent_type = "enterprise" if agent_id % 3 == 0 else "cloud"
+        agents.append({"agentId": agent_id, "agentName": f"Agent {agent_id}", "agentType": agent_type})
+
+    tests = []
+    results = {}
+    for test_id in range(1, test_count + 1):
+        test_type = TEST_TYPES[test_id % len(TEST_TYPES)]
+        # The v7 API returns ids as strings
+        test = {"testId": f"{test_id}", "testName": f"Test {test_id}", "type": test_type, "liveShare": False,
+                "interval": rnd.choice([60, 120, 300, 600, 900, 1800, 3600]), "alertsEnabled": True,
+                "enabled": test_id % 17 != 0, "protocol": "TCP", "createdBy": "bench",
+                "createdDate": "2024-10-01T00:00:00Z"}
+        if test_type in ("dns-server", "dns-trace"):
+            test["domain"] = f"example{test_id}.com"
+            test["dnsServers"] = [{"serverName": "ns1"}, {"serverName": "ns2"}]
+        elif test_type == "agent-to-server":
+            test["server"] = f"server{test_id}.example.com"
+        elif test_type == "bgp":
+            test["prefix"] = "10.0.0.0/8"
+        elif test_type in ("agent-to-agent", "voice"):
+            test["targetAgentId"] = rnd.choice(agents)["agentId"]
+            test["duration"] = 5
+            test["throughputMeasurements"] = test_id % 4 == 0
+            test["direction"] = rnd.choice(["bidirectional", "to-target", "from-target"])
+            test["throughputDuration"] = 10000
+        elif test_type == "sip-server":
+            test["sipRegistrar"] = "sip.example.com"
+            test["port"] = 5060
+            test["sipTimeLimit"] = 5
+        else:
+            test["url"] = f"https://example.com/{test_id}"
+        test["pageLoadTimeLimit"] = test["httpTimeLimit"] = test["timeLimit"] = test["ftpTimeLimit"] = 10
+        tests.append(test)
+
+        test_agents = rnd.sample(agents, rnd.randint(1, 10))
+        results[f"{test_id}"] = {"results": [{"agent": {"agentId": a["agentId"], "agentName": a["agentName"]}}
+                                        for a in test_agents]}
+        for round_number in range(1, rounds):
+            results[f"{test_id}"]["results"] += [
+                {"agent": {"agentId": a["agentId"], "agentName": a["agentName"]}, "roundId": 1727740800 + 60 * round_number,
+                 "date": "2024-10-01T00:00:00Z", "serverIp": "192.0.2.1", "server": "example.com:443",
+                 "avgLatency": 12.5, "minLatency": 10.1, "maxLatency": 20.2, "jitter": 1.3, "loss": 0.0,
+                 "permalink": f"https://app.thousandeyes.com/view/tests/?testId={test_id}&roundId={round_number}"}
+                for a in test_agents]
+        if config_agents:
+            test["agents"] = [dict(agent) for agent in test_agents]
+    return {"tests": tests, "agents": agents, "results": results}
+
+
+def account_routes(account, page_size=None):
+    """
+    Answers API requests from a synthetic account, see build_account
+    :param account:
+    :param page_size: items per page of /v7/tests and /v7/agents, None for a single page
+    :return: function(path, params, host) -> response body, None when not found
+    """
+    agents_by_id = {agent["agentId"]: agent for agent in account["agents"]}
+
+    def page(path, params, host, key, items):
+        # One page of items with a HAL next link, like the ThousandEyes API
+        if page_size is None:
+            return {key: items}
+        start = int(params.get("cursor", 0))
+        body = {key: items[start:start + page_size]}
+        if start + page_size < len(items):
+            body["_links"] = {"next": {"href": f"http://{host}{path}?{urlencode(dict(params, cursor=start + page_size))}"}}
+        return body
+
+    def route(path, params, host):
+        parts = path.strip("/").split("/")
+        if parts[1:] == ["account-groups"]:
+            return {"accountGroups": [{"accountGroupName": "Bench", "aid": "1"}]}
+        if parts[1:] == ["tests"]:
+            return page(path, params, host, "tests", account["tests"])
+        if parts[1:] == ["agents"]:
+            return page(path, params, host, "agents", account["agents"])
+        if parts[1] == "agents":
+            return agents_by_id.get(int(parts[2]))
+        if parts[1] == "test-results":
+            return account["results"].get(parts[2])
+        return None
+
+    return route
+
+
+def load_fixtures(filename):
+    """
+    Reads responses recorded by main.py --record
+    :param filename:
+    :return: dict of request key -> response body, see main.record_key
+    """
+    fixtures = {}
+    with open(filename) as file:
+        for line in file:
+            fixture = json.loads(line)
+            fixtures[main.record_key(fixture["path"], fixture["params"])] = fixture["body"]
+    return fixtures
+
+
+def fixture_routes(fixtures):
+    """
+    Answers API requests from recorded responses
+    :param fixtures: output of load_fixtures
+    :return: function(path, params, host) -> response body, None when not recorded
+    """
+    def route(path, params, host):
+        return fixtures.get(main.record_key(path, params))
+
+    return route
+
+
+def make_handler(route, latency, rate_limit, rate_window, request_count, capacity=None):
+    """
+    Creates a request handler answering like the ThousandEyes API
+    :param route: see account_routes and fixture_routes
+    :param latency: seconds to sleep before every response
+    :param rate_limit: requests allowed per rate_window, None for no limit
+    :param rate_window: seconds of a rate limit window
+    :param request_count: shared counter of received requests
+    :param capacity: concurrent requests answered within latency, more requests share it and wait longer,
+                     None for no limit
+    :return: BaseHTTPRequestHandler class
+    """
+    window = {"start": time.time(), "count": 0, "active": 0}
+    lock = threading.Lock()
+
+    class FakeThousandEyes(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def send_body(self, status, data, headers):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            with request_count.get_lock():
+                request_count.value += 1
+            headers = {}
+            if rate_limit is not None:
+                with lock:
+                    now = time.time()
+                    if now - window["start"] >= rate_window:
+                        window["start"], window["count"] = now, 0
+                    window["count"] += 1
+                    remaining = rate_limit - window["count"]
+                    reset = window["start"] + rate_window
+                headers = {"x-organization-rate-limit-limit": str(rate_limit),
+                           "x-organization-rate-limit-remaining": str(max(remaining, 0)),
+                           "x-organization-rate-limit-reset": str(int(math.ceil(reset)))}
+                if remaining < 0:
+                    headers["Retry-After"] = str(int(math.ceil(reset - now)))
+                    self.send_body(429, b'{}', headers)
+                    return
+
+            with lock:
+                window["active"] += 1
+                load = window["active"] / capacity if capacity else 1
+            time.sleep(latency * max(load, 1))
+            with lock:
+                window["active"] -= 1
+            url = urlparse(self.path)
+            params = {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+            body = route(url.path, params, self.headers["Host"])
+            if body is None:
+                self.send_body(404, b'{}', headers)
+                return
+            data = json.dumps(body).encode()
+            headers["ETag"] = f'"{hashlib.md5(data).hexdigest()}"'
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                self.send_body(304, b'', headers)
+                return
+            headers["Content-Type"] = "application/hal+json"
+            self.send_body(200, data, headers)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeThousandEyes
+
+
+def serve(route, latency, rate_limit, rate_window, request_count, port, capacity=None):
+    """
+    Runs the fake API until the process is terminated, sends the port it listens on through port
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(route, latency, rate_limit, rate_window,
+                                                                request_count, capacity))
+    server.daemon_threads = True
+    port.send(server.server_port)
+    server.serve_forever()
+
+
+class FakeServer:
+    """
+    Fake ThousandEyes API in its own process, so serving requests does not compete with the report for the GIL
+    """
+
+    def __init__(self, route, latency=0.0, rate_limit=None, rate_window=60, capacity=None):
+        context = multiprocessing.get_context("fork")
+        self.request_counter = context.Value("l", 0)
+        receiver, sender = context.Pipe(duplex=False)
+        self.process = context.Process(target=serve, daemon=True,
+                                       args=(route, latency, rate_limit, rate_window, self.request_counter, sender,
+                                             capacity))
+        self.process.start()
+        self.url = f"http://127.0.0.1:{receiver.recv()}"
+
+    @property
+    def request_count(self):
+        return self.request_counter.value
+
+    def shutdown(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def start_server(account, latency, page_size=None, rate_limit=None, rate_window=60, capacity=None):
+    """
+    Starts the fake API serving a synthetic account and points main.py at it
+    :param account: see build_account
+    :param latency: seconds to sleep before every response
+    :param page_size: items per page of /v7/tests and /v7/agents, None for a single page
+    :param rate_limit: requests allowed per rate_window, None for no limit
+    :param rate_window: seconds of a rate limit window
+    :param capacity: concurrent requests answered within latency, None for no limit
+    :return: FakeServer
+    """
+    server = FakeServer(account_routes(account, page_size), latency, rate_limit, rate_window, capacity)
+    main.BASE_URL = server.url
+    return server
+
+
+def reset_run_state():
+    """
+    Forgets the agent directory, HTTP session, coalesced requests and adaptive concurrency of the previous run
+    """
+    main.agent_directory = None
+    main.http_session = None
+    main.test_result_limiter = None
+    main.reset_coalesced_requests()
+
+
+def measure(results, phase, server, function, *args, **kwargs):
+    """
+    Runs one phase of the report and records its wall time, requests and peak memory
+    :param results: list the measurement is appended to
+    :param phase: name of the phase
+    :param server: FakeServer answering the requests
+    :param function: phase function
+    :return: value returned by function
+    """
+    requests_before = server.request_count
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    results.append({"phase": phase, "seconds": time.perf_counter() - start,
+                    "requests": server.request_count - requests_before, "peak_rss_mb": peak_rss_mb()})
+    return value
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far
+    :return: megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_suite(test_count, server, max_workers, filename):
+    """
+    Times every phase of the report against a running fake API
+    :param test_count: number of tests, printed with the results
+    :param server: FakeServer
+    :param max_workers: number of concurrent test result requests
+    :param filename: CSV written by convert_to_csv
+    :return: list of phase measurements
+    """
+    reset_run_state()
+    results = []
+    te_tests = measure(results, "get_te_tests", server, main.get_te_tests, "")
+    enterprise_agent_list = measure(results, "get_enterprise_agent_list", server, main.get_enterprise_agent_list)
+    te_tests = measure(results, "update_agent_count", server, main.update_agent_count, te_tests,
+                       enterprise_agent_list, max_workers=max_workers)
+    te_tests = measure(results, "calculate_usage_manual", server, main.calculate_usage_manual, te_tests)
+    measure(results, "convert_to_csv", server, main.convert_to_csv, te_tests["tests"], filename)
+    for result in results:
+        result["tests"] = test_count
+    return results
+
+
+def print_results(results):
+    """
+    Prints suite measurements as a table
+    :param results: list of phase measurements, see measure
+    """
+    print(f"{'tests':>8}  {'phase':<26}{'wall time':>10}{'requests':>10}{'peak RSS':>11}")
+    for result in results:
+        print(f"{result['tests']:>8}  {result['phase']:<26}{result['seconds']:>9.2f}s{result['requests']:>10}"
+              f"{result['peak_rss_mb']:>8.0f} MB")
+
+
+def time_update_agent_count(max_workers):
+    """
+    Times get_te_tests and update_agent_count for a worker count
+    :param max_workers: None for the adaptive concurrency starting at main.Max_Workers
+    :return: (seconds, report rows)
+    """
+    reset_run_state()
+    te_tests = main.get_te_tests("")
+    enterprise_agent_list = main.get_enterprise_agent_list()
+    start = time.perf_counter()
+    te_updated_tests = main.update_agent_count(te_tests, enterprise_agent_list, max_workers=max_workers)
+    return time.perf_counter() - start, te_updated_tests["tests"]
+
+
+def time_report(processes, batch_size, basename):
+    """
+    Times run_report with the transform stage in this process or in transform processes
+    :param processes: Transform_Processes, 0 for this process
+    :param batch_size: Transform_Batch_Size
+    :param basename: report file name without extension
+    :return: (seconds, CPU seconds of this process, CSV report)
+    """
+    reset_run_state()
+    main.Transform_Processes = processes
+    main.Transform_Batch_Size = batch_size
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    filenames = main.run_report("", basename)
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    with open(filenames[0]) as file:
+        return seconds, cpu_seconds, file.read()
+
+
+def time_command(command, runs):
+    """
+    Median wall time of a command
+    :param command: argument list
+    :param runs: number of runs
+    :return: milliseconds
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    # Time with cached bytecode, as an installed script would start
+    env = {name: value for name, value in os.environ.items() if name != "PYTHONDONTWRITEBYTECODE"}
+    subprocess.run(command, cwd=directory, env=env, stdout=subprocess.DEVNULL, check=True)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=directory, env=env, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def time_startup(runs):
+    """
+    Times importing main.py and its offline commands against STARTUP_BUDGET_MS
+    :param runs: number of runs of each command
+    :return: list of (name, milliseconds, milliseconds over the bare interpreter)
+    """
+    baseline = time_command([sys.executable, "-c", "pass"], runs)
+    commands = [("import main", [sys.executable, "-c", "import main"]),
+                ("-m main --help", [sys.executable, "-m", "main", "--help"]),
+                ("-m main price --help", [sys.executable, "-m", "main", "price", "--help"]),
+                ("main.py --help", [sys.executable, "main.py", "--help"])]
+    results = [("python -c pass", baseline, 0.0)]
+    for name, command in commands:
+        milliseconds = time_command(command, runs)
+        results.append((name, milliseconds, milliseconds - baseline))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the ThousandEyes test report against a fake API")
+    parser.add_argument("--latency", type=float, default=20, help="milliseconds before every response")
+    parser.add_argument("--workers", type=int, default=main.Max_Workers,
+                        help="concurrent test result requests")
+    parser.add_argument("--rate-limit", type=int, help="requests allowed per minute, default no limit")
+    parser.add_argument("--page-size", type=int, help="tests and agents per page, default a single page")
+    parser.add_argument("--config-agents", action="store_true",
+                        help="list the agents in the test configs, so no test results are requested")
+    commands = parser.add_subparsers(dest="command", required=True)
+    concurrency = commands.add_parser("concurrency", help="compare sequential and concurrent update_agent_count")
+    concurrency.add_argument("--tests", type=int, default=200)
+    suite = commands.add_parser("suite", help="time every phase of the report on synthetic accounts")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000])
+    transform = commands.add_parser("transform", help="compare the transform stage in this process and in a process pool")
+    transform.add_argument("--tests", type=int, default=3000)
+    transform.add_argument("--rounds", type=int, default=20, help="test results per agent")
+    transform.add_argument("--processes", type=int, default=os.cpu_count())
+    transform.add_argument("--batch-size", type=int, default=main.Transform_Batch_Size)
+    replay = commands.add_parser("replay", help="time the report on responses recorded with main.py --record")
+    replay.add_argument("fixtures")
+    adaptive = commands.add_parser("adaptive", help="compare a fixed number of workers with the adaptive concurrency")
+    adaptive.add_argument("--tests", type=int, default=1000)
+    adaptive.add_argument("--capacity", type=int, default=12,
+                          help="concurrent requests the fake API answers within --latency, more wait longer")
+    startup = commands.add_parser("startup", help="time importing main.py and its offline commands")
+    startup.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    latency = args.latency / 1000
+
+    if args.command == "startup":
+        loaded = [module for module in LAZY_MODULES
+                  if module in subprocess.run([sys.executable, "-c", "import main, sys; print(*sys.modules)"],
+                                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True,
+                                              text=True, check=True).stdout.split()]
+        print(f"{'command':<24}{'wall time':>10}{'overhead':>10}")
+        for name, milliseconds, overhead in time_startup(args.runs):
+            # Running the file compiles it on every start; only "-m main" is held to the budget
+            budget = "" if name in ("python -c pass", "main.py --help") else "ok" if overhead <= STARTUP_BUDGET_MS else "over budget"
+            print(f"{name:<24}{milliseconds:>7.0f} ms{overhead:>7.0f} ms  {budget}")
+        print(f"modules loaded by import main: {', '.join(loaded) or 'none of ' + ', '.join(LAZY_MODULES)}")
+    elif args.command == "concurrency":
+        server = start_server(build_account(args.tests, config_agents=args.config_agents), latency, args.page_size, args.rate_limit)
+        sequential_time, sequential_rows = time_update_agent_count(1)
+        concurrent_time, concurrent_rows = time_update_agent_count(args.workers)
+        server.shutdown()
+
+        assert sequential_rows == concurrent_rows, "concurrent report differs from sequential report"
+        print(f"{args.tests} tests, {args.latency:.0f} ms latency")
+        print(f"update_agent_count sequential:           {sequential_time:.2f}s")
+        print(f"update_agent_count concurrent ({args.workers} workers): {concurrent_time:.2f}s")
+        print(f"speedup: {sequential_time / concurrent_time:.1f}x")
+    elif args.command == "adaptive":
+        account = build_account(args.tests, config_agents=args.config_agents)
+        main.Max_Workers = args.workers
+        main.Max_In_Flight = max(main.Max_In_Flight, main.Adaptive_Max_Workers)
+        measurements = []
+        # A new fake API for each run, so both start with a full rate limit window
+        for max_workers in (args.workers, None):
+            server = start_server(account, latency, args.page_size, args.rate_limit, capacity=args.capacity)
+            main.reset_run_profile()
+            measurements.append(time_update_agent_count(max_workers) + (server.request_count,))
+            server.shutdown()
+        (fixed_time, fixed_rows, fixed_requests), (adaptive_time, adaptive_rows, adaptive_requests) = measurements
+        concurrency = main.run_profile['concurrency']
+
+        assert fixed_rows == adaptive_rows, "adaptive concurrency report differs from the fixed workers report"
+        print(f"{args.tests} tests, {args.latency:.0f} ms latency, capacity {args.capacity}, "
+              f"rate limit {args.rate_limit or 'none'}")
+        print(f"{'update_agent_count':<34}{'wall time':>10}{'requests':>10}")
+        print(f"{f'{args.workers} workers':<34}{fixed_time:>9.2f}s{fixed_requests:>10}")
+        print(f"{'adaptive, up to ' + str(main.Adaptive_Max_Workers):<34}{adaptive_time:>9.2f}s{adaptive_requests:>10}")
+        if concurrency is not None:
+            print(f"limit {concurrency['start']} -> {concurrency['limit']} (lowest {concurrency['lowest']}, highest "
+                  f"{concurrency['highest']}), backoffs: {concurrency['backoffs']}")
+    elif args.command == "transform":
+        server = start_server(build_account(args.tests, config_agents=args.config_agents, rounds=args.rounds),
+                              latency, args.page_size, args.rate_limit)
+        with tempfile.TemporaryDirectory() as directory:
+            basename = os.path.join(directory, "report")
+            in_process = time_report(0, args.batch_size, basename)
+            pooled = time_report(args.processes, args.batch_size, basename)
+        server.shutdown()
+
+        assert in_process[2] == pooled[2], "transform processes report differs from the in-process report"
+        print(f"{args.tests} tests, {args.rounds} rounds, {args.latency:.0f} ms latency, {os.cpu_count()} CPUs")
+        print(f"{'transform stage':<34}{'wall time':>10}{'report process CPU':>20}")
+        print(f"{'in the report process':<34}{in_process[0]:>9.2f}s{in_process[1]:>19.2f}s")
+        print(f"{f'{args.processes} processes, batches of {args.batch_size}':<34}{pooled[0]:>9.2f}s{pooled[1]:>19.2f}s")
+    else:
+        all_results = []
+        with tempfile.TemporaryDirectory() as directory:
+            if args.command == "suite":
+                for size in args.sizes:
+                    server = start_server(build_account(size, config_agents=args.config_agents), latency, args.page_size, args.rate_limit)
+                    all_results += run_suite(size, server, args.workers, os.path.join(directory, "report.csv"))
+                    server.shutdown()
+            else:
+                fixtures = load_fixtures(args.fixtures)
+                test_count = sum(len(body["tests"]) for key, body in fixtures.items()
+                                 if json.loads(key)[0] == "/v7/tests")
+                server = FakeServer(fixture_routes(fixtures), latency, args.rate_limit)
+                main.BASE_URL = server.url
+                all_results += run_suite(test_count, server, args.workers, os.path.join(directory, "report.csv"))
+                server.shutdown()
+        print_results(all_results)
@@ -20,649 +20,3241 @@ __copyright__ = "Copyright (c) 2024 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
 import sys
-import requests
+import argparse
 import csv
-from dotenv import load_dotenv
 import os
+import time
+import math
+import json
+import hashlib
+import re
+import itertools
+import io
+import queue
+import codecs
 from datetime import date
+from urllib.parse import urlsplit, parse_qsl, parse_qs
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager, nullcontext
 
-# Load environment variable from .env file
-load_dotenv()
+# Bearer token of the ThousandEyes API, read from the BEARER_TOKEN environment variable or the .env file on first use
+BEARER_TOKEN = None
 
-# Access environment variable
-BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+# (Optional) set account group name
+Account_Group_Name = ""
+
+# ThousandEyes API base URL
+BASE_URL = "https://api.thousandeyes.com"
+
+# Number of test results fetched concurrently (1 fetches them one after another)
+Max_Workers = 8
+
+# Processes that decode the test results and convert, count and price the tests, see transform_batch.
+# 0 does this work in the report process, set it to the number of cores for large accounts
+Transform_Processes = 0
+
+# Tests sent to a transform process at once
+Transform_Batch_Size = 16
+
+# Number of account groups reported at the same time with --all-account-groups/--account-groups
+Max_Account_Groups = 4
+
+# Maximum number of API requests in flight at any time, across all account groups and workers
+Max_In_Flight = 16
+
+# Adapt the number of concurrent test result requests to the API, starting at Max_Workers: the limit grows while
+# the latency stays stable and shrinks on 429 responses or rising latency, see AdaptiveLimiter
+Adaptive_Concurrency = True
+
+# Highest limit of the adaptive concurrency, Max_In_Flight also caps it
+Adaptive_Max_Workers = 32
+
+# HTTP client settings: connect and read timeouts in seconds, retries on 429/5xx and the base backoff in seconds
+Connect_Timeout = 10
+Read_Timeout = 120
+Max_Retries = 5
+Backoff_Factor = 1
+
+# Test results the agents are counted from: a window (ex: "2m", "1h"), or "" for the most recent round only
+Test_Result_Window = "2m"
+
+# (Optional) number of rounds of each test's interval to count agents from, overrides Test_Result_Window, 0 disables
+Test_Result_Rounds = 0
+
+# Count the agents listed in the test config instead of requesting the test results, when the config lists them
+Use_Test_Config_Agents = True
+
+# (Optional) sqlite file caching API responses between runs, "" disables the cache
+Cache_File = ""
+
+# Seconds a cached response is used without asking the API, by path prefix (0 or missing: not cached)
+Cache_TTL = {
+    "/v7/account-groups": 24 * 3600,
+    "/v7/agents": 24 * 3600,
+    "/v7/tests": 3600,
+    "/v7/test-results": 0,
+}
+
+# (Optional) json file enabling the incremental mode, "" fetches the test results of every test on every run
+Incremental_State_File = ""
+
+# Seconds before the agent counts of an unchanged test are fetched again in incremental mode
+Incremental_Max_Age = 24 * 3600
+
+# Fetch the test results of the tests with the most expected impact first, see test_priority.
+# The report keeps the order of the tests
+Priority_Scheduling = False
+
+# Seconds an account group may request test results for, 0 for no deadline, implies Priority_Scheduling.
+# Tests not fetched in time keep their agent counts of the previous incremental run and are marked CarriedOver
+Fetch_Deadline = 0
+
+# Priority weight of each test type, multiplies the previous Monthly_usage, types not listed weigh 1
+# ex: {"web-transactions": 2, "page-load": 2, "agent-to-server": 0.5}
+Test_Type_Weights = {}
+
+# Checkpoint journal of finished rows, used by --resume to continue an interrupted run
+Journal_File = "te_report_journal.jsonl"
+
+# (Optional) jsonl file every API response is appended to, replayed offline by benchmark.py
+Record_File = ""
+
+# Identical API requests of a run share one request and its decoded response, see single_flight.
+# At most this many responses are kept, the least recently used are dropped first; 0 turns it off
+Coalesce_Max_Entries = 4096
+
+# (Optional) sqlite file keeping the rows of every run for trend and delta queries, "" disables the history
+History_File = ""
+
+# Output formats of the report, any of "csv", "ndjson" (gzip compressed JSON Lines) and "parquet" (needs pyarrow)
+Report_Formats = ("csv",)
+
+# Rows per Parquet row group
+Parquet_Batch_Rows = 10000
+
+# Daemon mode (--daemon): local HTTP endpoint serving the report and seconds between two refreshes of the report
+Daemon_Host = "127.0.0.1"
+Daemon_Port = 8080
+Refresh_Interval = 3600
+
+# Agent types counted as Enterprise agents
+ENTERPRISE_AGENT_TYPES = ("enterprise", "enterprise-cluster")
+
+# Agent directory, loaded once per run by get_agent_directory()
+agent_directory = None
+agent_directory_lock = threading.Lock()
+
+# Shared HTTP session and the last rate limit reported by the API
+transform_pool = None
+transform_pool_lock = threading.Lock()
+
+http_session = None
+http_session_lock = threading.Lock()
+rate_limit = {'remaining': None, 'reset': 0.0, 'throttled': 0}
+rate_limit_lock = threading.Lock()
+in_flight_requests = None
+test_result_limiter = None
+
+# Response cache connection, opened by get_cache()
+response_cache = None
+response_cache_lock = threading.Lock()
+
+record_lock = threading.Lock()
+coalesced_requests = OrderedDict()
+coalesced_requests_lock = threading.Lock()
+
+# Report served by the daemon mode, replaced at once by every refresh, see build_report_index
+report_index = None
+report_index_lock = threading.Lock()
+daemon_status = {'refreshed': None, 'seconds': None, 'error': None}
+
+# Run profile: pipeline phase times, API requests per endpoint and cache hits, see write_run_profile
+run_profile = {'started': time.time(), 'phases': {}, 'endpoints': {}, 'cache_hits': 0, 'coalesced': 0,
+               'concurrency': None}
+run_profile_lock = threading.Lock()
+profile_phases = threading.local()
+
+# Upper bounds in milliseconds of the request latency histogram
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Adaptive concurrency: the limit changes after every window of max(limit, ADAPTIVE_MIN_SAMPLES) test result
+# requests. A window with a 429, or whose p95 latency exceeds ADAPTIVE_LATENCY_TOLERANCE times the baseline plus
+# ADAPTIVE_LATENCY_SLACK seconds, multiplies the limit by its ADAPTIVE_BACKOFF factor, any other window adds one.
+# The baseline is the lowest window p95, raised by ADAPTIVE_BASELINE_DRIFT per window so it follows a slower API
+ADAPTIVE_MIN_SAMPLES = 20
+ADAPTIVE_LATENCY_TOLERANCE = 1.5
+ADAPTIVE_LATENCY_SLACK = 0.05
+ADAPTIVE_BACKOFF = {'throttled': 0.5, 'latency': 0.8}
+ADAPTIVE_BASELINE_DRIFT = 1.01
+
+# Bytes read from the network at a time by the streaming json decoder, see iter_json_items
+JSON_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_NUMBER_CHARACTERS = frozenset("0123456789.eE+-")
+
+# Decoded items of a paged endpoint are handed to the consumer in batches, see api_get_pages
+PAGE_BATCH_ITEMS = 200
+PAGE_QUEUE_BATCHES = 5
+
+# Report columns filled by update_agent_count
+AGENT_COUNT_KEYS = ("CloudAgents", "CloudAgentsList", "EnterpriseAgent", "EnterpriseAgentsList")
+
+# Test fields only used for pricing, removed from the report by calculate_usage_manual
+PRICING_KEYS = ("servers", "timeout", "duration", "Throughput", "direction", "ThroughputDuration", "targetAgentId")
+
+# Columns of the report, in order. CarriedOver is only set by runs with a Fetch_Deadline
+REPORT_COLUMNS = ("TestId", "TestName", "TeShared", "TestType", "Interval", "AlertsEnabled", "Enabled", "Protocol",
+                  "CreatedBy", "CreatedDate", "Target", "CloudAgents", "CloudAgentsList", "EnterpriseAgent",
+                  "EnterpriseAgentsList", "Monthly_usage", "CarriedOver")
+RECORD_FIELDS = frozenset(REPORT_COLUMNS + ("targetAgentId", "agents"))
+
+# Report columns stored as numbers in the usage history, the other columns are the test config
+HISTORY_USAGE_COLUMNS = frozenset(("CloudAgents", "EnterpriseAgent", "Monthly_usage"))
+
+# Report columns the usage history is rolled up by, see usage_rollup
+ROLLUP_COLUMNS = ("TestType", "CreatedBy")
+
+# Column types of the typed outputs (ndjson, parquet), other columns are strings.
+# TestId stays a string, the v7 API returns ids as strings
+INTEGER_COLUMNS = frozenset(("Interval", "CloudAgents", "EnterpriseAgent", "Monthly_usage"))
+BOOLEAN_COLUMNS = frozenset(("TeShared", "AlertsEnabled", "Enabled", "CarriedOver"))
+LIST_COLUMNS = ("CloudAgentsList", "EnterpriseAgentsList")
+
+# Test field holding the time limit of each test type priced by it
+TIME_LIMIT_FIELDS = {
+    "page-load": "pageLoadTimeLimit",
+    "http-server": "httpTimeLimit",
+    "api": "timeLimit",
+    "web-transactions": "timeLimit",
+    "sip-server": "sipTimeLimit",
+    "ftp-server": "ftpTimeLimit",
+}
+
+# Units added as per TE cost calculation page
+# CloudAgent/EntAgent: units per agent and round, Multiplier: test field the units are multiplied by,
+# MultiplierScale: the field is divided by it first ex: milliseconds to seconds, Interval: fixed test interval
+Units = {
+    "Agent_to_Server": {"CloudAgent": 5, "EntAgent": 2.5, "Multiplier": None, "TestTypes": ("agent-to-server",)},
+    "Agent_to_Agent": {"CloudAgent": 5, "EntAgent": 2.5, "Multiplier": None, "TestTypes": ("agent-to-agent",)},
+    "Agent_to_Agent_TE": {"EntAgent": 0.5, "Multiplier": "ThroughputDuration", "MultiplierScale": 1000,
+                          "TestTypes": ()},
+    "DNS_Server": {"CloudAgent": 5, "EntAgent": 2.5, "Multiplier": "servers", "TestTypes": ("dns-server",)},
+    "Page_Load": {"CloudAgent": 1, "EntAgent": 0.5, "Multiplier": "timeout", "TestTypes": ("page-load",)},
+    "DNS_Trace": {"CloudAgent": 5, "EntAgent": 2.5, "Multiplier": None, "TestTypes": ("dns-trace",)},
+    "HTTP_Server": {"CloudAgent": 1, "EntAgent": 0.5, "Multiplier": "timeout", "TestTypes": ("http-server", "api")},
+    "FTP_Server": {"CloudAgent": 1, "EntAgent": 0.5, "Multiplier": "timeout", "TestTypes": ("ftp-server",)},
+    "Voice_RTP": {"CloudAgent": 1, "EntAgent": 0.5, "Multiplier": "duration", "TestTypes": ("rtp-server",)},
+    "Voice_SIP": {"CloudAgent": 1, "EntAgent": 0.5, "Multiplier": "timeout", "TestTypes": ("sip-server",)},
+    "Web_Trans": {"CloudAgent": 1, "EntAgent": 0.5, "Multiplier": "timeout", "TestTypes": ("web-transactions",)},
+    "BGP": {"CloudAgent": 8, "Multiplier": None, "Interval": 900, "TestTypes": ("bgp",)}
+}
+UNIT_BY_TEST_TYPE = {test_type: name for name, unit in Units.items() for test_type in unit["TestTypes"]}
+
+# Fields the usage of a test depends on, see pricing_config
+PRICING_FIELDS = ("TestType", "TeShared", "Interval", "CloudAgents", "EnterpriseAgent", "servers", "timeout",
+                  "duration", "Throughput", "direction", "ThroughputDuration", "targetAgentType")
+
+# Settings the transform processes take from the report process, they may be changed after import
+TRANSFORM_SETTINGS = ("Use_Test_Config_Agents",)
+
+# Pricing rule of a test in calculate_monthly_usage
+USAGE_NONE, USAGE_TABLE, USAGE_A2A_LATENCY, USAGE_A2A_THROUGHPUT, USAGE_BGP = range(5)
+
+
+class ThousandEyesError(Exception):
+    """
+    Raised when a ThousandEyes API request fails
+    """
+
+
+class ThousandEyesHTTPError(ThousandEyesError):
+    """
+    Raised when the API answers with an error status code
+    """
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ThousandEyesConnectionError(ThousandEyesError):
+    """
+    Raised when the API cannot be reached or does not answer in time
+    """
+
+
+class TestRecord:
+    """
+    Report row of one test, see convert_test.
+    Columns are slots instead of dict keys; type specific pricing fields live in a small extension record.
+    Supports dict style access, ex: test["TestId"], so the pipeline accepts records and plain dicts alike.
+    """
+    __slots__ = REPORT_COLUMNS + ("targetAgentId", "agents", "extension")
+
+    def __init__(self, **fields):
+        self.extension = None
+        for name, value in fields.items():
+            self[name] = value
+
+    def __getitem__(self, key):
+        if key in PRICING_KEYS and key != "targetAgentId":
+            return getattr(self.extension, key, "NotApplicable")
+        if key not in RECORD_FIELDS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in RECORD_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in RECORD_FIELDS and hasattr(self, key)
+
+    def __eq__(self, other):
+        if isinstance(other, TestRecord):
+            return self.as_dict() == other.as_dict()
+        return self.as_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"TestRecord({self.as_dict()!r})"
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """
+        Report columns that are set, in report order
+        :return: list of column names
+        """
+        return [name for name in REPORT_COLUMNS if hasattr(self, name)]
+
+    def values(self):
+        """
+        Values of the report columns that are set, in report order
+        :return: list
+        """
+        return [getattr(self, name) for name in REPORT_COLUMNS if hasattr(self, name)]
+
+    def as_dict(self):
+        """
+        Report columns that are set as a dict
+        :return: dict
+        """
+        return {name: getattr(self, name) for name in REPORT_COLUMNS if hasattr(self, name)}
+
+
+class DnsServerFields:
+    """
+    Pricing fields of dns-server tests
+    """
+    __slots__ = ("servers",)
+
+    def __init__(self, servers):
+        self.servers = servers
+
+
+class TimeLimitFields:
+    """
+    Pricing fields of tests priced by their time limit, see TIME_LIMIT_FIELDS
+    """
+    __slots__ = ("timeout",)
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+
+class VoiceFields:
+    """
+    Pricing fields of voice (rtp-server) tests
+    """
+    __slots__ = ("duration",)
+
+    def __init__(self, duration):
+        self.duration = duration
+
+
+class AgentToAgentFields:
+    """
+    Pricing fields of agent-to-agent tests
+    """
+    __slots__ = ("Throughput", "direction", "ThroughputDuration")
+
+    def __init__(self, throughput, direction, throughput_duration):
+        self.Throughput = throughput
+        self.direction = direction
+        self.ThroughputDuration = throughput_duration
+
+
+def reset_run_profile():
+    """
+    Clears the run profile, see write_run_profile
+    """
+    global run_profile
+    with run_profile_lock:
+        run_profile = {'started': time.time(), 'phases': {}, 'endpoints': {}, 'cache_hits': 0, 'coalesced': 0,
+                       'concurrency': None}
+
+
+def endpoint_name(path):
+    """
+    Groups API paths by endpoint, ids are replaced by {id}
+    :param path: ex: /v7/test-results/123/network
+    :return: ex: /v7/test-results/{id}/network
+    """
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+def profile_request(path, seconds, received, status_code=None, retried=False):
+    """
+    Adds one API request attempt to the run profile
+    :param path: API path
+    :param seconds: time until the response was read
+    :param received: bytes of the response body
+    :param status_code: None when the request failed without a response
+    :param retried: the request is sent again after this attempt
+    """
+    name = endpoint_name(path)
+    with run_profile_lock:
+        endpoint = run_profile['endpoints'].get(name)
+        if endpoint is None:
+            endpoint = {'requests': 0, 'retries': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0, 'status_codes': {},
+                        'latency_ms': {f"<={bound}": 0 for bound in LATENCY_BUCKETS_MS}}
+            endpoint['latency_ms']["inf"] = 0
+            run_profile['endpoints'][name] = endpoint
+        endpoint['requests'] += 1
+        endpoint['bytes'] += received
+        endpoint['seconds'] += seconds
+        if retried:
+            endpoint['retries'] += 1
+        if status_code is None or (status_code >= 400 and not retried):
+            endpoint['errors'] += 1
+        status = f"{status_code}" if status_code is not None else "no response"
+        endpoint['status_codes'][status] = endpoint['status_codes'].get(status, 0) + 1
+        bucket = next((f"<={bound}" for bound in LATENCY_BUCKETS_MS if seconds * 1000 <= bound), "inf")
+        endpoint['latency_ms'][bucket] += 1
+
+
+def profile_received(path, received):
+    """
+    Adds the bytes of a streamed response body to the run profile, see api_get_items
+    :param path: API path
+    :param received: bytes of the response body
+    """
+    with run_profile_lock:
+        run_profile['endpoints'][endpoint_name(path)]['bytes'] += received
+
+
+def profile_concurrency(previous, limit, reason, p95):
+    """
+    Adds a change of the adaptive concurrency limit to the run profile, see AdaptiveLimiter
+    :param previous: limit before the change
+    :param limit: new limit
+    :param reason: throttled, latency, or None when the limit grew
+    :param p95: p95 latency in seconds of the window of requests
+    """
+    with run_profile_lock:
+        concurrency = run_profile['concurrency']
+        if concurrency is None:
+            concurrency = {'start': previous, 'limit': previous, 'lowest': previous, 'highest': previous,
+                           'backoffs': {name: 0 for name in ADAPTIVE_BACKOFF}, 'changes': []}
+            run_profile['concurrency'] = concurrency
+        concurrency['limit'] = limit
+        concurrency['lowest'] = min(concurrency['lowest'], limit)
+        concurrency['highest'] = max(concurrency['highest'], limit)
+        if reason is not None:
+            concurrency['backoffs'][reason] += 1
+        if limit != previous:
+            concurrency['changes'].append({'seconds': round(time.time() - run_profile['started'], 3),
+                                           'limit': limit, 'reason': reason, 'p95_ms': round(p95 * 1000, 1)})
+
+
+@contextmanager
+def profile_phase(name):
+    """
+    Adds the time spent in the block to a pipeline phase of the run profile.
+    Phases are exclusive: a phase entered inside another one pauses it.
+    :param name: phase name ex: pricing
+    """
+    if not hasattr(profile_phases, 'stack'):
+        profile_phases.stack = []
+    stack = profile_phases.stack
+    now = time.perf_counter()
+    if stack:
+        add_phase_time(stack[-1][0], now - stack[-1][1])
+    stack.append([name, now])
+    try:
+        yield
+    finally:
+        name, start = stack.pop()
+        now = time.perf_counter()
+        add_phase_time(name, now - start)
+        if stack:
+            stack[-1][1] = now
+
+
+def add_phase_time(name, seconds):
+    """
+    Adds seconds to a pipeline phase of the run profile
+    :param name:
+    :param seconds:
+    """
+    with run_profile_lock:
+        run_profile['phases'][name] = run_profile['phases'].get(name, 0.0) + seconds
+
+
+def write_run_profile(basename):
+    """
+    Writes the run profile as json next to a report
+    :param basename: report file name without extension ex: te_report_2024-10-01
+    :return: profile filename ex: te_report_2024-10-01.profile.json
+    """
+    profile_filename = f"{basename}.profile.json"
+    with run_profile_lock:
+        profile = dict(run_profile, total_seconds=time.time() - run_profile['started'])
+        with open(profile_filename, 'w') as file:
+            json.dump(profile, file, indent=2)
+    return profile_filename
+
+
+def print_run_profile():
+    """
+    Prints the run profile as summary tables
+    """
+    with run_profile_lock:
+        print(f"\n{'phase':<24}{'seconds':>10}")
+        for name, seconds in sorted(run_profile['phases'].items(), key=lambda item: -item[1]):
+            print(f"{name:<24}{seconds:>10.2f}")
+        print(f"\n{'endpoint':<40}{'requests':>9}{'retries':>8}{'errors':>7}{'MB':>9}{'avg ms':>8}")
+        for name, endpoint in sorted(run_profile['endpoints'].items()):
+            average = endpoint['seconds'] * 1000 / endpoint['requests']
+            print(f"{name:<40}{endpoint['requests']:>9}{endpoint['retries']:>8}{endpoint['errors']:>7}"
+                  f"{endpoint['bytes'] / 1e6:>9.2f}{average:>8.0f}")
+        print(f"cache hits: {run_profile['cache_hits']}, coalesced requests: {run_profile['coalesced']}")
+        concurrency = run_profile['concurrency']
+        if concurrency is not None:
+            print(f"concurrency limit: {concurrency['start']} -> {concurrency['limit']} "
+                  f"(lowest {concurrency['lowest']}, highest {concurrency['highest']}), backoffs: "
+                  + ", ".join(f"{count} {reason}" for reason, count in concurrency['backoffs'].items()))
+
+
+def get_bearer_token():
+    """
+    Returns the API token, loading the .env file on first use so importing this module reads no file
+    :return: BEARER_TOKEN
+    """
+    global BEARER_TOKEN
+    if BEARER_TOKEN is None:
+        from dotenv import load_dotenv
+        load_dotenv()
+        BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+    return BEARER_TOKEN
+
+
+def get_in_flight_requests():
+    """
+    Returns the semaphore limiting the API requests in flight to Max_In_Flight, creating it on first use
+    :return: threading.BoundedSemaphore
+    """
+    global in_flight_requests
+    with http_session_lock:
+        if in_flight_requests is None:
+            in_flight_requests = threading.BoundedSemaphore(Max_In_Flight)
+        return in_flight_requests
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit of the concurrent test result requests, shared by every account group, see iter_agent_counts.
+    Requests beyond the limit wait for a slot. The limit grows by one per window of requests while their p95
+    latency stays near the baseline, and backs off after a 429 or a slower window, see ADAPTIVE_BACKOFF.
+    """
+
+    def __init__(self, limit, maximum, minimum=1):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = min(max(limit, minimum), self.maximum)
+        self.active = 0
+        self.latencies = []
+        self.baseline = None
+        self.backed_off = False
+        self.throttled = rate_limit['throttled']
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def request(self):
+        """
+        Holds a slot while a request runs and adds its latency to the window, failed requests are not counted
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        start = time.perf_counter()
+        latency = None
+        try:
+            yield
+            latency = time.perf_counter() - start
+        finally:
+            with self.condition:
+                self.active -= 1
+                if latency is not None:
+                    self.latencies.append(latency)
+                    if len(self.latencies) >= max(self.limit, ADAPTIVE_MIN_SAMPLES):
+                        self.adjust()
+                self.condition.notify_all()
+
+    def adjust(self):
+        """
+        Changes the limit at the end of a window of requests, called with the condition held
+        """
+        latencies = sorted(self.latencies)
+        self.latencies = []
+        p95 = latencies[math.ceil(0.95 * len(latencies)) - 1]
+        with rate_limit_lock:
+            throttled = rate_limit['throttled'] > self.throttled
+            self.throttled = rate_limit['throttled']
+        if self.baseline is None:
+            self.baseline = p95
+
+        previous = self.limit
+        if throttled:
+            reason = "throttled"
+        elif self.backed_off:
+            # Requests sent before the last backoff finish in this window, so its latency is not judged
+            reason = None
+        elif p95 > ADAPTIVE_LATENCY_TOLERANCE * self.baseline + ADAPTIVE_LATENCY_SLACK:
+            reason = "latency"
+        else:
+            reason = None
+            self.limit = min(self.limit + 1, self.maximum)
+        if reason is not None:
+            self.limit = max(int(self.limit * ADAPTIVE_BACKOFF[reason]), self.minimum)
+        else:
+            self.baseline = min(p95, self.baseline * ADAPTIVE_BASELINE_DRIFT)
+        self.backed_off = reason is not None
+        profile_concurrency(previous, self.limit, reason, p95)
+        if reason is not None and self.limit != previous:
+            cause = "429 Too Many Requests" if reason == "throttled" else f"p95 latency {p95 * 1000:.0f} ms"
+            print(f"Concurrency limit {previous} -> {self.limit}: {cause}")
+
+
+def get_test_result_limiter():
+    """
+    Returns the adaptive concurrency limiter of the test result requests, creating it on first use.
+    It keeps its limit between runs of the daemon.
+    :return: AdaptiveLimiter starting at Max_Workers, up to Adaptive_Max_Workers and Max_In_Flight
+    """
+    global test_result_limiter
+    with http_session_lock:
+        if test_result_limiter is None:
+            test_result_limiter = AdaptiveLimiter(Max_Workers, min(Adaptive_Max_Workers, Max_In_Flight))
+        return test_result_limiter
+
+
+def test_result_concurrency(max_workers=None):
+    """
+    Threads and limiter of the test result requests
+    :param max_workers: fixed number of concurrent requests, None for Max_Workers adapted by the limiter
+    :return: (number of threads, AdaptiveLimiter or None for a fixed number)
+    """
+    if max_workers is not None or not Adaptive_Concurrency or Max_Workers <= 1:
+        return max_workers or Max_Workers, None
+    limiter = get_test_result_limiter()
+    return limiter.maximum, limiter
+
+
+def get_session():
+    """
+    Returns the shared requests Session, creating it on first use.
+    The connection pool is sized for Max_Workers so concurrent requests reuse kept-alive connections.
+    requests is imported here, so the offline parts of this module load without it.
+    :return: requests.Session
+    """
+    global http_session
+    import requests
+    with http_session_lock:
+        if http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(Max_Workers, Max_In_Flight))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept": "application/hal+json"})
+            http_session = session
+        return http_session
+
+
+def wait_for_rate_limit():
+    """
+    Sleeps until the rate limit window resets when the API reported no remaining requests
+    """
+    with rate_limit_lock:
+        remaining = rate_limit['remaining']
+        delay = rate_limit['reset'] - time.time()
+    if remaining is not None and remaining <= 0 and delay > 0:
+        time.sleep(delay)
+
+
+def update_rate_limit(response):
+    """
+    Records the ThousandEyes organization rate limit headers of a response
+    :param response:
+    """
+    remaining = response.headers.get("x-organization-rate-limit-remaining")
+    reset = response.headers.get("x-organization-rate-limit-reset")
+    if remaining is None:
+        return
+    with rate_limit_lock:
+        rate_limit['remaining'] = int(remaining)
+        if reset is not None:
+            rate_limit['reset'] = float(reset)
+
+
+def retry_delay(response, attempt):
+    """
+    Seconds to wait before retrying a request
+    Uses Retry-After or the rate limit reset time when the API sends them, exponential backoff otherwise.
+    :param response: failed response, None for connection errors
+    :param attempt: number of the failed attempt, starting at 0
+    :return: delay in seconds
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        reset = response.headers.get("x-organization-rate-limit-reset")
+        if response.status_code == 429 and reset is not None:
+            return max(float(reset) - time.time(), 0.0)
+    return Backoff_Factor * (2 ** attempt)
+
+
+def send_request(path, params=None, extra_headers=None, stream=False):
+    """
+    GET request to the ThousandEyes API over the shared session.
+    Retries with backoff on 429, 5xx, connection errors and timeouts.
+    :param path: API path ex: /v7/tests
+    :param params: query parameters
+    :param extra_headers: additional request headers ex: If-None-Match
+    :param stream: return once the headers are received, the caller reads and closes the body.
+                   The request keeps its Max_In_Flight slot until the caller releases it after closing the body,
+                   see api_get_items
+    :return: requests.Response with a 2xx or 304 status code
+    :raises ThousandEyesHTTPError: the API answered with an error status code
+    :raises ThousandEyesConnectionError: the API could not be reached
+    """
+    import requests
+    url = f"{BASE_URL}{path}"
+    headers = {"Authorization": f"Bearer {get_bearer_token()}"}
+    if extra_headers:
+        headers.update(extra_headers)
+    in_flight = get_in_flight_requests()
+    for attempt in range(Max_Retries + 1):
+        wait_for_rate_limit()
+        start = time.perf_counter()
+        in_flight.acquire()
+        try:
+            response = get_session().get(url, headers=headers, params=params, stream=stream,
+                                         timeout=(Connect_Timeout, Read_Timeout))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as conn_err:
+            in_flight.release()
+            profile_request(path, time.perf_counter() - start, 0, retried=attempt < Max_Retries)
+            if attempt == Max_Retries:
+                raise ThousandEyesConnectionError(f"Connection error occurred: {conn_err}") from conn_err
+            time.sleep(retry_delay(None, attempt))
+            continue
+        except BaseException:
+            in_flight.release()
+            raise
+
+        if not stream:
+            in_flight.release()
+        update_rate_limit(response)
+        if response.status_code == 429:
+            with rate_limit_lock:
+                rate_limit['throttled'] += 1
+        retried = response.status_code in RETRY_STATUS_CODES and attempt < Max_Retries
+        profile_request(path, time.perf_counter() - start, 0 if stream else len(response.content),
+                        response.status_code, retried)
+        if retried:
+            response.close()
+            if stream:
+                in_flight.release()
+            time.sleep(retry_delay(response, attempt))
+            continue
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as http_err:
+            if stream:
+                response.close()
+                in_flight.release()
+            raise ThousandEyesHTTPError(f"HTTP error occurred: {http_err}", response.status_code) from http_err
+        return response
+
+
+def get_cache():
+    """
+    Returns the sqlite connection of the response cache, opening it on first use
+    :return: sqlite3.Connection, None when Cache_File is not set
+    """
+    global response_cache
+    if not Cache_File:
+        return None
+    import sqlite3
+    with response_cache_lock:
+        if response_cache is None:
+            connection = sqlite3.connect(Cache_File, check_same_thread=False)
+            connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB NOT NULL, "
+                               "etag TEXT, last_modified TEXT, fetched REAL NOT NULL)")
+            connection.commit()
+            response_cache = connection
+        return response_cache
+
+
+def cache_ttl(path):
+    """
+    Finds the cache TTL of an endpoint, the longest matching prefix in Cache_TTL wins
+    :param path: API path ex: /v7/test-results/123/network
+    :return: TTL in seconds, 0 when the endpoint is not cached
+    """
+    matches = [prefix for prefix in Cache_TTL if path.startswith(prefix)]
+    if not matches:
+        return 0
+    return Cache_TTL[max(matches, key=len)]
+
+
+def cache_key(path, params):
+    """
+    Builds the cache key of a request from the API URL, path, params and token
+    The token is hashed so responses of different accounts never share an entry.
+    :param path:
+    :param params:
+    :return: key string
+    """
+    token = hashlib.sha256(f"{get_bearer_token()}".encode()).hexdigest()[:16]
+    return json.dumps([BASE_URL, path, sorted((params or {}).items()), token], default=str)
+
+
+def cached_api_get(path, params=None):
+    """
+    GET request to the ThousandEyes API, answered from the response cache when possible.
+    Cached responses younger than the endpoint TTL are returned without a request, older ones are
+    revalidated with If-None-Match/If-Modified-Since when the API sent an ETag or Last-Modified.
+    :param path: API path ex: /v7/tests
+    :param params: query parameters
+    :return: decoded json response
+    :raises ThousandEyesHTTPError: the API answered with an error status code
+    :raises ThousandEyesConnectionError: the API could not be reached
+    """
+    cache = get_cache()
+    ttl = cache_ttl(path)
+    if cache is None or ttl <= 0:
+        return send_request(path, params).json()
+
+    key = cache_key(path, params)
+    with response_cache_lock:
+        row = cache.execute("SELECT body, etag, last_modified, fetched FROM responses WHERE key = ?",
+                            (key,)).fetchone()
+    extra_headers = {}
+    if row is not None:
+        body, etag, last_modified, fetched = row
+        if time.time() - fetched < ttl:
+            with run_profile_lock:
+                run_profile['cache_hits'] += 1
+            return json.loads(body)
+        if etag:
+            extra_headers["If-None-Match"] = etag
+        if last_modified:
+            extra_headers["If-Modified-Since"] = last_modified
+
+    response = send_request(path, params, extra_headers)
+    if response.status_code == 304 and row is not None:
+        with response_cache_lock:
+            cache.execute("UPDATE responses SET fetched = ? WHERE key = ?", (time.time(), key))
+            cache.commit()
+        return json.loads(row[0])
+
+    with response_cache_lock:
+        cache.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                      (key, response.content, response.headers.get("ETag"),
+                       response.headers.get("Last-Modified"), time.time()))
+        cache.commit()
+    return response.json()
+
+
+def reset_coalesced_requests():
+    """
+    Forgets the responses shared by single_flight, called at the start of every run
+    """
+    with coalesced_requests_lock:
+        coalesced_requests.clear()
+
+
+def single_flight(key, fetch, keep=True):
+    """
+    Calls fetch once per key and run: calls with the same key wait for the first one and share its result.
+    Failures are shared with the calls already waiting but not kept, the next call runs fetch again.
+    :param key: request key ex: record_key(path, params)
+    :param fetch: function without arguments
+    :param keep: False shares the result only with the calls made while fetch runs, for large results
+    :return: result of fetch, the same object for every caller so it must not be modified
+    """
+    if Coalesce_Max_Entries <= 0:
+        return fetch()
+    with coalesced_requests_lock:
+        entry = coalesced_requests.get(key)
+        leader = entry is None
+        if leader:
+            entry = {'done': threading.Event(), 'value': None, 'error': None}
+            coalesced_requests[key] = entry
+            while len(coalesced_requests) > Coalesce_Max_Entries:
+                coalesced_requests.popitem(last=False)
+        else:
+            coalesced_requests.move_to_end(key)
+
+    if not leader:
+        entry['done'].wait()
+        with run_profile_lock:
+            run_profile['coalesced'] += 1
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['value']
+
+    try:
+        entry['value'] = fetch()
+    except Exception as err:
+        entry['error'] = err
+        raise
+    finally:
+        if entry['error'] is not None or not keep:
+            with coalesced_requests_lock:
+                if coalesced_requests.get(key) is entry:
+                    del coalesced_requests[key]
+        entry['done'].set()
+    return entry['value']
+
+
+def api_get(path, params=None):
+    """
+    GET request to the ThousandEyes API used by every fetch helper.
+    Identical requests of a run are sent once, see single_flight. Test results are large and requested once per
+    test, so they are only shared with identical requests in flight and not kept for the rest of the run.
+    Responses are appended to Record_File when it is set, see record_response.
+    :param path: API path ex: /v7/tests
+    :param params: query parameters
+    :return: decoded json response, shared by identical requests so it must not be modified
+    :raises ThousandEyesHTTPError: the API answered with an error status code
+    :raises ThousandEyesConnectionError: the API could not be reached
+    """
+    def fetch():
+        body = cached_api_get(path, params)
+        if Record_File:
+            record_response(path, params, body)
+        return body
+
+    return single_flight(record_key(path, params), fetch, keep=not path.startswith("/v7/test-results"))
+
+
+def record_key(path, params):
+    """
+    Key identifying a request in recorded fixtures
+    :param path:
+    :param params:
+    :return: key string
+    """
+    return json.dumps([path, sorted((name, f"{value}") for name, value in (params or {}).items())])
+
+
+def record_response(path, params, body):
+    """
+    Appends a response to the Record_File fixtures, replayed by benchmark.py replay
+    :param path:
+    :param params:
+    :param body: decoded json response
+    """
+    line = json.dumps({'path': path, 'params': {name: f"{value}" for name, value in (params or {}).items()},
+                       'body': body})
+    with record_lock:
+        with open(Record_File, 'a') as file:
+            file.write(line + "\n")
+
+
+def split_link(href):
+    """
+    Splits a HAL link into the API path and query parameters used by api_get
+    :param href: ex: https://api.thousandeyes.com/v7/tests?aid=1234&cursor=abc
+    :return: (path, params)
+    """
+    parts = urlsplit(href)
+    return parts.path, dict(parse_qsl(parts.query))
+
+
+def iter_json_items(chunks, items_key):
+    """
+    Incremental decoder of a json object: yields the items of its items_key array while the chunks arrive.
+    Every value is decoded by the C scanner of the json module, the other members of the object are decoded whole.
+    :param chunks: iterator of bytes
+    :param items_key: key of the array ex: tests
+    :return: generator of items, returns the other members of the object as a dict
+    :raises ThousandEyesError: the chunks are not a json object
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = 0
+    exhausted = False
+
+    def fill(minimum):
+        # Drops the decoded text and appends at least minimum characters
+        nonlocal buffer, pos, exhausted
+        parts = [buffer[pos:]]
+        added = 0
+        while added < minimum and not exhausted:
+            chunk = next(chunks, None)
+            part = text.decode(chunk) if chunk is not None else text.decode(b"", final=True)
+            exhausted = chunk is None
+            parts.append(part)
+            added += len(part)
+        buffer = "".join(parts)
+        pos = 0
+
+    def skip():
+        # Skips whitespace and returns the next character
+        nonlocal pos
+        while True:
+            pos = JSON_WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if exhausted:
+                raise ThousandEyesError("Truncated json response")
+            fill(1)
+
+    def value():
+        # Decodes the value at pos, a value ending at the end of the buffer may continue in the next chunk.
+        # A number cut after its "." or exponent decodes as a shorter number followed by the rest of it.
+        nonlocal pos
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+                cut = (isinstance(obj, (int, float)) and not isinstance(obj, bool) and end < len(buffer)
+                       and buffer[end] in JSON_NUMBER_CHARACTERS)
+                if (end < len(buffer) and not cut) or exhausted:
+                    pos = end
+                    return obj
+            except json.JSONDecodeError as err:
+                if exhausted:
+                    raise ThousandEyesError(f"Invalid json response: {err}") from err
+            # Doubles the undecoded text before decoding again, so long values are not decoded over and over
+            fill(max(len(buffer) - pos, 1))
+
+    def expect(characters):
+        nonlocal pos
+        character = skip()
+        if character not in characters:
+            raise ThousandEyesError(f"Invalid json response: unexpected {character!r}")
+        pos += 1
+        return character
+
+    rest = {}
+    expect("{")
+    if skip() == "}":
+        return rest
+    while True:
+        skip()
+        key = value()
+        expect(":")
+        if key == items_key and skip() == "[":
+            pos += 1
+            if skip() == "]":
+                pos += 1
+            else:
+                while True:
+                    skip()
+                    yield value()
+                    if expect(",]") == "]":
+                        break
+        else:
+            skip()
+            rest[key] = value()
+        if expect(",}") == "}":
+            return rest
+
+
+def streams_response(path):
+    """
+    Whether api_get_items receives the responses of an endpoint while it decodes them,
+    and not whole through api_get because they are recorded or cached
+    :param path: API path ex: /v7/tests
+    :return: bool
+    """
+    return not (Record_File or (get_cache() is not None and cache_ttl(path) > 0))
+
+
+def api_get_items(path, items_key, params=None):
+    """
+    GET request yielding the items of one array of the json response while the response is received,
+    so the whole body is never held in memory.
+    Responses that are cached or recorded are decoded whole, see api_get.
+    :param path: API path ex: /v7/tests
+    :param items_key: key of the items in the response ex: tests
+    :param params: query parameters
+    :return: generator of items, returns the other members of the response as a dict
+    :raises ThousandEyesHTTPError: the API answered with an error status code
+    :raises ThousandEyesConnectionError: the API could not be reached
+    """
+    if not streams_response(path):
+        body = dict(api_get(path, params))
+        yield from body.pop(items_key, [])
+        return body
+
+    import requests
+    response = send_request(path, params, stream=True)
+    received = 0
+
+    def chunks():
+        nonlocal received
+        try:
+            for chunk in response.iter_content(JSON_CHUNK_SIZE):
+                received += len(chunk)
+                yield chunk
+        except requests.exceptions.RequestException as conn_err:
+            raise ThousandEyesConnectionError(f"Connection error occurred: {conn_err}") from conn_err
+
+    try:
+        return (yield from iter_json_items(chunks(), items_key))
+    finally:
+        response.close()
+        get_in_flight_requests().release()
+        profile_received(path, received)
+
+
+def api_get_pages(path, items_key, params=None):
+    """
+    Yields the items of every page of an endpoint, following the HAL _links.next link.
+    Pages are decoded item by item in a background thread while the items are consumed: the next page is
+    requested as soon as the current one is received, and at most PAGE_QUEUE_BATCHES batches of
+    PAGE_BATCH_ITEMS items wait for the consumer.
+    :param path: API path ex: /v7/tests
+    :param items_key: key of the items in each page ex: tests
+    :param params: query parameters of the first page
+    :return: generator of items
+    """
+    batches = queue.Queue(maxsize=PAGE_QUEUE_BATCHES)
+    stop = threading.Event()
+    end = object()
+    failure = []
+
+    def put(batch, streaming=False):
+        # Waits for room in the queue, gives up when the consumer stopped.
+        # While a page is streaming its in-flight slot is given up during the wait, see send_request:
+        # the consumer may need a slot to make room
+        try:
+            batches.put_nowait(batch)
+            return True
+        except queue.Full:
+            pass
+        if streaming:
+            get_in_flight_requests().release()
+        try:
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            if streaming:
+                get_in_flight_requests().acquire()
+
+    def page_items():
+        link = (path, params)
+        while link is not None:
+            rest = yield from api_get_items(link[0], items_key, link[1])
+            next_link = rest.get('_links', {}).get('next', {}).get('href')
+            link = split_link(next_link) if next_link else None
+
+    def produce():
+        pages = page_items()
+        batch = []
+        try:
+            for item in pages:
+                batch.append(item)
+                if len(batch) >= PAGE_BATCH_ITEMS:
+                    if not put(batch, streaming=streams_response(path)):
+                        return
+                    batch = []
+        except Exception as err:
+            failure.append(err)
+        finally:
+            pages.close()
+        if not batch or put(batch):
+            put(end)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is end:
+                break
+            yield from batch
+    finally:
+        stop.set()
+    if failure:
+        raise failure[0]
+
+
+def get_account_groups():
+    """
+    API that returns the account groups the token has access to
+    :return: list of dicts ex: [{'aid': '1234', 'accountGroupName': 'Default', ...}]
+    """
+    return api_get("/v7/account-groups")['accountGroups']
+
+
+def get_account_id(account_name):
+    """
+        API that returns account info
+        :return: aid of the account group
+        :raises ThousandEyesError: no account group has this name
+    """
+    for acc in get_account_groups():
+        if acc['accountGroupName'] == account_name:
+            return acc["aid"]
+    raise ThousandEyesError(f"Unknown account group: {account_name}")
+
+def get_te_tests(aid):
+    """
+    API that returns configured tests and saved events.
+    :return: dict with the list of test dicts and the config fingerprint of each test id
+    """
+    fingerprints = {}
+    tests = list(iter_te_tests(aid, fingerprints))
+    return {'tests': tests, 'fingerprints': fingerprints}
+
+
+def iter_te_tests(aid, fingerprints=None):
+    """
+    Yields the test dict of every configured test as the pages of /v7/tests arrive
+    :param aid: account group id, "" for the default account group
+    :param fingerprints: dict filled with the config fingerprint of each test id before the test is yielded,
+                         used by the incremental mode
+    :return: generator of test dicts
+    """
+    pages = api_get_pages("/v7/tests", 'tests', params={"aid": f"{aid}"})
+    while True:
+        with profile_phase("fetch_tests"):
+            test = next(pages, None)
+        if test is None:
+            return
+        with profile_phase("convert_tests"):
+            if fingerprints is not None:
+                fingerprints[test['testId']] = test_fingerprint(test)
+            test_dict = convert_test(test, aid)
+        yield test_dict
+
+
+def convert_test(test, aid=""):
+    """
+    Converts a test returned by /v7/tests into a report test record
+    :param test:
+    :param aid: account group id, "" for the default account group
+    :return: TestRecord
+    """
+    test_dict = TestRecord()
+    test_dict["TestId"] = test['testId']
+    test_dict["TestName"] = test['testName']
+    test_dict["TeShared"] = test['liveShare']
+
+    # Test Type
+    if test['type'] == 'voice':
+        test_dict["TestType"] = 'rtp-server'
+    else:
+        test_dict["TestType"] = test['type']
+    if 'targetAgentId' in test.keys():
+        test_dict["targetAgentId"] = test['targetAgentId']
+    else:
+        test_dict["targetAgentId"] = "NotApplicable"
+    # Interval
+    if 'interval' in test:
+        test_dict["Interval"] = test['interval']
+    else:
+        test_dict["Interval"] = ""
+
+    test_dict["AlertsEnabled"] = test['alertsEnabled']
+    test_dict["Enabled"] = test['enabled']
+
+    # Protocol
+    if 'protocol' in test:
+        test_dict["Protocol"] = test['protocol']
+    else:
+        test_dict["Protocol"] = ""
+
+    # Created By
+    if "createdBy" in test:
+        test_dict["CreatedBy"] = test['createdBy']
+    else:
+        test_dict["CreatedBy"] = "unknown"
+
+    # Created Date
+    if "createdDate" in test:
+        test_dict["CreatedDate"] = test['createdDate']
+    else:
+        test_dict["CreatedDate"] = "unknown"
+
+    # Target
+    if test['type'] == 'dns-server' or test['type'] == 'dns-trace' or test['type'] == 'dnssec':
+        test_dict["Target"] = test['domain']
+    elif test['type'] == 'agent-to-server':
+        test_dict["Target"] = test['server']
+    elif (test['type'] == 'page-load' or test['type'] == 'http-server' or test['type'] == 'api'
+          or test['type'] == 'web-transactions' or test['type'] == 'ftp-server'):
+        test_dict["Target"] = test['url']
+    elif test['type'] == 'agent-to-agent' or test['type'] == 'voice':
+        agent_name = agent_id_to_agent_name(test['targetAgentId'], aid)
+        test_dict["Target"] = agent_name
+    elif test['type'] == 'bgp':
+        test_dict["Target"] = test['prefix']
+    elif test['type'] == 'sip-server':
+        test_dict["Target"] = test['sipRegistrar'] + ':' + str(test['port'])
+    else:
+        test_dict["Target"] = 'unknown'
+
+    # Agents listed in the test config, counted instead of the test results
+    if Use_Test_Config_Agents and test.get('agents'):
+        test_dict["agents"] = test['agents']
+
+    # Type specific fields used for pricing
+    if test['type'] == 'dns-server':
+        # Amount of DNS servers check
+        test_dict.extension = DnsServerFields(len(test['dnsServers']))
+    elif test['type'] in TIME_LIMIT_FIELDS:
+        # Time Load Limit
+        test_dict.extension = TimeLimitFields(test[TIME_LIMIT_FIELDS[test['type']]])
+    elif test['type'] == "voice":
+        # Duration
+        test_dict.extension = VoiceFields(test["duration"])
+    elif test['type'] == "agent-to-agent":
+        # Throughput
+        test_dict.extension = AgentToAgentFields(test["throughputMeasurements"], test["direction"],
+                                                 test.get("throughputDuration", "NotApplicable"))
+
+    return test_dict
+
+
+def test_fingerprint(test):
+    """
+    Hash of a test configuration as returned by /v7/tests, changes when any setting of the test changes
+    :param test:
+    :return: sha256 hex digest
+    """
+    config = {key: value for key, value in test.items() if key != '_links'}
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_te_test_result(test_id, test_type, params=None):
+    """
+    Returns network test results for every agent and round.
+    If you do not specify a window or a start and end date, data is displayed for the most recent testing round.
+    :param test_id:
+    :param test_type:
+    :param params: query parameters selecting the rounds, defaults to the Test_Result_Window window
+    :return: resp
+    """
+    if params is None:
+        params = {"window": Test_Result_Window} if Test_Result_Window else {}
+    return api_get(f"/v7/test-results/{test_id}/{test_type}", params=params or None)
+
+
+def iter_te_test_results(test_id, test_type, params=None):
+    """
+    Yields the test results of a test while the response is received, see get_te_test_result
+    :param test_id:
+    :param test_type:
+    :param params: query parameters selecting the rounds, defaults to the Test_Result_Window window
+    :return: generator of test results
+    """
+    if params is None:
+        params = {"window": Test_Result_Window} if Test_Result_Window else {}
+    return api_get_items(f"/v7/test-results/{test_id}/{test_type}", 'results', params=params or None)
+
+
+def test_result_params(test, aid=""):
+    """
+    Query parameters selecting the test results the agents of a test are counted from
+    :param test:
+    :param aid: account group id of the test, "" for the default account group
+    :return: dict ex: {"window": "2m"}, {"window": "600s"} for Test_Result_Rounds = 2 and a 300s interval,
+             {} for the most recent round, plus {"aid": aid} for other account groups
+    """
+    params = {"aid": f"{aid}"} if aid else {}
+    if Test_Result_Rounds and test['Interval']:
+        params["window"] = f"{Test_Result_Rounds * test['Interval']}s"
+    elif Test_Result_Window:
+        params["window"] = Test_Result_Window
+    return params
+
+
+def load_agent_directory(aid=""):
+    """
+    Downloads every agent available to an account group once and indexes it.
+    :param aid: account group id, "" for the default account group
+    :return: dict ex: {'names': {12345: 'San Jose, CA'}, 'types': {12345: 'enterprise'}, 'enterprise': {12345}}
+    """
+
+    directory = {'names': {}, 'types': {}, 'enterprise': set()}
+    for agent in api_get_pages("/v7/agents", 'agents', params={"aid": f"{aid}"} if aid else None):
+        directory['names'][agent['agentId']] = agent['agentName']
+        directory['types'][agent['agentId']] = agent['agentType']
+        if agent['agentType'] in ENTERPRISE_AGENT_TYPES:
+            directory['enterprise'].add(agent['agentId'])
+    return directory
+
+
+def get_agent_directory(aid=None):
+    """
+    Returns the agent directory, loading the agents of an account group on first use.
+    Agent ids are unique across account groups, so every account group shares one directory.
+    :param aid: account group whose agents must be loaded, None for any already loaded account group
+    :return: agent directory, see load_agent_directory
+    """
+    global agent_directory
+    with agent_directory_lock:
+        if agent_directory is None:
+            agent_directory = {'names': {}, 'types': {}, 'enterprise': set(), 'account_groups': set()}
+        if aid is None:
+            if agent_directory['account_groups']:
+                return agent_directory
+            aid = ""
+        if aid not in agent_directory['account_groups']:
+            with profile_phase("fetch_agents"):
+                directory = load_agent_directory(aid)
+            agent_directory['names'].update(directory['names'])
+            agent_directory['types'].update(directory['types'])
+            agent_directory['enterprise'].update(directory['enterprise'])
+            agent_directory['account_groups'].add(aid)
+        return agent_directory
+
+
+def get_enterprise_agent_list(aid=""):
+    """
+    Returns all Enterprise agents available to your ThousandEyes account,
+    including both Enterprise and Cluster.
+    :param aid: account group id, "" for the default account group
+    :return: enterprise agents id set Ex:{12345, 67890}
+    """
+    return get_agent_directory(aid)['enterprise']
+
+
+def get_agent_type(agent_Id):
+    """
+    Find the type of agent 
+    :return: agent type , cloud or enterprise
+    """
+    return get_agent_directory()['types'].get(agent_Id, "NotApplicable")
+
+
+def get_agent_count(test_result, enterprise_agent_list):
+    """
+    Finds the number of agents and locations for a test
+    Each result row costs a few hash lookups, so results can be counted while they are still being received.
+    :param test_result: list or iterator of test results
+    :param enterprise_agent_list: set of enterprise agent ids, see get_enterprise_agent_list
+    :return: TE dict with ex: CloudAgents: 2, CloudAgentList: ['San Francisco, CA', 'New York, NY']
+    """
+    if not isinstance(enterprise_agent_list, (set, frozenset, dict)):
+        enterprise_agent_list = set(enterprise_agent_list)
+
+    # Agent id -> agent name, in the order the agents first appear
+    cloud_agents = {}
+    ent_agents = {}
+
+    for result in test_result:
+        agent_id = result['agent']['agentId']
+        # Check to see if the agent is an enterprise agent
+        agents = ent_agents if agent_id in enterprise_agent_list else cloud_agents
+        # If the agent is not already added: add it
+        if agent_id not in agents:
+            agents[agent_id] = result['agent']['agentName']
+
+    # Format the cloud and enterprise agents data
+    agent = {'agent_count': len(cloud_agents), 'agent_ids': list(cloud_agents),
+             'agent_names': list(cloud_agents.values()),
+             'e_agent_count': len(ent_agents), 'e_agent_ids': list(ent_agents),
+             'e_agent_names': list(ent_agents.values())}
+
+    return agent
+
+
+def fetch_agent_name(agent_id, aid=""):
+    """
+    Requests the name of a single agent from the API.
+    :param agent_id:
+    :param aid: account group id, "" for the default account group
+    :return: agentName ex:12345 -> San Jose, CA
+    """
+
+    return api_get(f"/v7/agents/{agent_id}", params={"aid": f"{aid}"} if aid else None)['agentName']
+
+
+def agent_id_to_agent_name(agent_id, aid=""):
+    """
+    Returns the name of an agent based on the agent id.
+    Agents missing from the agent directory are requested once and added to it.
+    :param agent_id:
+    :param aid: account group id, "" for the default account group
+    :return: agentName ex:12345 -> San Jose, CA
+    """
+    names = get_agent_directory(aid)['names']
+    if agent_id not in names:
+        names[agent_id] = fetch_agent_name(agent_id, aid)
+    return names[agent_id]
+
+
+def get_result_test_type(test):
+    """
+    Maps a report test type to the test-results endpoint type
+    :param test:
+    :return: test type used by /v7/test-results ex: agent-to-server -> network
+    """
+    if test['TestType'] == 'agent-to-server' or test['TestType'] == 'agent-to-agent':
+        return "network"
+    return test['TestType']
+
+
+def needs_test_result(test):
+    """
+    Checks if the agent count of a test has to be read from its test results
+    :param test:
+    :return: False for disabled and bgp tests, True otherwise
+    """
+    return bool(test["Enabled"]) and test['TestType'] != 'bgp'
+
+
+def config_agent_results(test):
+    """
+    Agents listed in the test config in the shape of test results, see convert_test
+    :param test:
+    :return: list of results ex: [{'agent': {'agentId': 12345, 'agentName': 'San Jose, CA'}}], None when not listed
+    """
+    agents = test.get("agents")
+    if not agents:
+        return None
+    return [{'agent': agent} for agent in agents]
+
+
+def set_agent_count(test, agent):
+    """
+    Adds the CloudAgents, CloudAgentsList, EnterpriseAgent and EnterpriseAgentsList entries to a test
+    :param test:
+    :param agent: output of get_agent_count
+    """
+    # Update cloud agents
+    test["CloudAgents"] = agent["agent_count"]
+    if agent["agent_count"] == 0:
+        test["CloudAgentsList"] = ""
+    else:
+        test["CloudAgentsList"] = agent["agent_names"]
+
+    # Update enterprise agents
+    test["EnterpriseAgent"] = agent["e_agent_count"]
+    if agent["e_agent_count"] == 0:
+        test["EnterpriseAgentsList"] = ""
+    else:
+        test["EnterpriseAgentsList"] = agent["e_agent_names"]
+
+
+def set_test_agents(test, enterprise_agent_dict, reused, count):
+    """
+    Adds the agent counts to a test from its test results, its config or the previous run
+    :param test:
+    :param enterprise_agent_dict:
+    :param reused: agent counts to keep, see reusable_agent_counts, None when the test is counted
+    :param count: function returning the get_agent_count of the test results, only called when they are needed
+    """
+    # If test is not enabled or is a bgp test set the values to 0 and empty string
+    if not needs_test_result(test):
+        test["CloudAgents"] = 0
+        test["CloudAgentsList"] = ""
+        test["EnterpriseAgent"] = 0
+        test["EnterpriseAgentsList"] = ""
+    # Agents listed in the test config need no test results
+    elif config_agent_results(test) is not None:
+        with profile_phase("count_agents"):
+            set_agent_count(test, get_agent_count(config_agent_results(test), enterprise_agent_dict))
+    # Unchanged tests keep the agent counts of the previous run
+    elif reused is not None:
+        for key in AGENT_COUNT_KEYS:
+            test[key] = reused[key]
+    # Use the test results to get the agent count for each test
+    else:
+        with profile_phase("fetch_test_results"):
+            agent = count()
+        with profile_phase("count_agents"):
+            set_agent_count(test, agent)
+
+
+def iter_agent_counts(tests, enterprise_agent_dict, max_workers=None, reuse=None, carry=None, deadline=None,
+                      aid=""):
+    """
+    Yields every test with its agent counts, in the order of tests, see iter_agent_count_batches
+    :return: generator of test dicts
+    """
+    for batch in iter_agent_count_batches(tests, enterprise_agent_dict, max_workers, reuse, carry, deadline, aid):
+        yield from batch
+
+
+def iter_agent_count_batches(tests, enterprise_agent_dict, max_workers=None, reuse=None, carry=None, deadline=None,
+                             aid=""):
+    """
+    Yields the tests with their agent counts in batches, in the order of tests.
+    Test results are fetched by up to max_workers threads, at most 2 * max_workers tests ahead of the consumer.
+    Each thread counts the agents of a test while its test results are received.
+    A batch is the next test and the tests after it whose agents are already counted, so they are priced together.
+    :param tests: test dicts, see get_te_tests
+    :param enterprise_agent_dict:
+    :param max_workers: number of concurrent test result requests, None for Max_Workers adapted to the API,
+                        see test_result_concurrency
+    :param reuse: agent counts by test id to use instead of fetching the test results, see reusable_agent_counts
+    :param carry: previous state entries by test id as a string, see load_report_state, kept after the deadline
+    :param deadline: time.monotonic() after which the tests in carry are not fetched, None for no deadline.
+                     Every test gets a CarriedOver column, True for the tests that kept their carry entry
+    :param aid: account group id of the tests, "" for the default account group
+    :return: generator of lists of test dicts
+    """
+    max_workers, limiter = test_result_concurrency(max_workers)
+    limit = limiter.request if limiter is not None else nullcontext
+    if reuse is None:
+        reuse = {}
+    if carry is None:
+        carry = {}
+
+    def carried_over(test):
+        # After the deadline tests with previous agent counts keep them instead of being fetched
+        if deadline is None:
+            return False
+        previous = carry.get(str(test['TestId']))
+        if test['TestId'] in reuse or previous is None or time.monotonic() < deadline:
+            return False
+        reuse[test['TestId']] = previous
+        return True
+
+    def count(test_id, test_type, params):
+        with limit():
+            return get_agent_count(iter_te_test_results(test_id, test_type, params), enterprise_agent_dict)
+
+    def fetch(test):
+        # Count the agents of the test results using the test id and test type for each test
+        # Identical requests of several account groups are counted once, see single_flight
+        test_type = get_result_test_type(test)
+        params = test_result_params(test, aid)
+        return single_flight(("agent_count", record_key(f"/v7/test-results/{test['TestId']}/{test_type}", params)),
+                             lambda: count(test['TestId'], test_type, params))
+
+    def finish(test, result):
+        set_test_agents(test, enterprise_agent_dict, reuse.get(test['TestId']),
+                        lambda: result.result() if max_workers > 1 else fetch(test))
+        if deadline is not None and "CarriedOver" not in test:
+            test["CarriedOver"] = False
+        return test
+
+    if max_workers <= 1:
+        for test in tests:
+            if needs_test_result(test) and not test.get("agents") and carried_over(test):
+                test["CarriedOver"] = True
+            yield [finish(test, None)]
+        return
+
+    def ready():
+        # The next test of the window and the tests after it that need no more waiting
+        batch = [finish(*window.popleft())]
+        while window and (window[0][1] is None or window[0][1].done()):
+            batch.append(finish(*window.popleft()))
+        return batch
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window = deque()
+        for test in tests:
+            if needs_test_result(test) and test['TestId'] not in reuse and not test.get("agents"):
+                if carried_over(test):
+                    test["CarriedOver"] = True
+                    window.append((test, None))
+                else:
+                    window.append((test, executor.submit(fetch, test)))
+            else:
+                window.append((test, None))
+            if len(window) > 2 * max_workers:
+                yield ready()
+        while window:
+            yield ready()
+
+
+def update_agent_count(te_test_dict, enterprise_agent_dict, max_workers=None, reuse=None):
+    """
+    Updates a dictionary with a new entry for CloudAgents and CloudAgentsList
+    Test results are fetched concurrently by up to max_workers threads, tests keep the order of get_te_tests.
+    :param enterprise_agent_dict:
+    :param te_test_dict:
+    :param max_workers: number of concurrent test result requests, None for Max_Workers adapted to the API
+    :param reuse: agent counts by test id to use instead of fetching the test results, see reusable_agent_counts
+    :return: dict with Agent updates
+    """
+    for _ in iter_agent_counts(te_test_dict['tests'], enterprise_agent_dict, max_workers, reuse):
+        pass
+    return te_test_dict
+
+
+def load_report_state():
+    """
+    Reads the agent counts and config fingerprints saved by the previous incremental run
+    :return: dict ex: {'tests': {'123': {'fingerprint': 'ab12..', 'fetched': 1728000000.0, 'CloudAgents': 2, ...}}}
+    """
+    if not Incremental_State_File or not os.path.exists(Incremental_State_File):
+        return {'tests': {}}
+    with open(Incremental_State_File) as file:
+        return json.load(file)
+
+
+def reusable_agent_counts(te_test_dict, state, max_age=None):
+    """
+    Finds the tests whose agent counts can be reused from the previous run:
+    the test config is unchanged and its test results were fetched less than max_age seconds ago
+    :param te_test_dict: output of get_te_tests
+    :param state: output of load_report_state
+    :param max_age: seconds before agent counts are fetched again, defaults to Incremental_Max_Age
+    :return: dict of test id -> previous state entry
+    """
+    reuse = {}
+    now = time.time()
+    for test_id, fingerprint in te_test_dict['fingerprints'].items():
+        previous = reusable_state_entry(test_id, fingerprint, state, now, max_age)
+        if previous is not None:
+            reuse[test_id] = previous
+    return reuse
+
+
+def reusable_state_entry(test_id, fingerprint, state, now, max_age=None):
+    """
+    Returns the previous state entry of a test if its agent counts can be reused, see reusable_agent_counts
+    :param test_id:
+    :param fingerprint: see test_fingerprint
+    :param state: output of load_report_state
+    :param now: current time
+    :param max_age: seconds before agent counts are fetched again, defaults to Incremental_Max_Age
+    :return: state entry or None
+    """
+    if max_age is None:
+        max_age = Incremental_Max_Age
+    previous = state['tests'].get(str(test_id))
+    if previous is not None and previous['fingerprint'] == fingerprint and now - previous['fetched'] < max_age:
+        return previous
+    return None
+
+
+def iter_reusable(tests, fingerprints, state, reuse):
+    """
+    Passes tests through, adding the tests whose agent counts can be reused to reuse as they stream.
+    Tests already in reuse, ex: rows of an interrupted run, are kept as they are.
+    :param tests: test dicts, see iter_te_tests
+    :param fingerprints: filled by iter_te_tests
+    :param state: output of load_report_state
+    :param reuse: dict of test id -> previous state entry, see reusable_agent_counts
+    :return: generator of test dicts
+    """
+    now = time.time()
+    for test in tests:
+        if test['TestId'] not in reuse:
+            previous = reusable_state_entry(test['TestId'], fingerprints[test['TestId']], state, now)
+            if previous is not None:
+                reuse[test['TestId']] = previous
+        yield test
+
+
+def report_state_entry(test, fingerprint, reuse, now):
+    """
+    Incremental mode state of a test: config fingerprint, fetch time, agent counts and Monthly_usage once priced
+    :param test: test dict with agent counts
+    :param fingerprint: see test_fingerprint
+    :param reuse: output of reusable_agent_counts, reused tests keep their fetch time and the fingerprint their
+                  agent counts were fetched with, so a carried over test whose config changed is fetched next time
+    :param now: fetch time of tests that were not reused
+    :return: dict
+    """
+    entry = {'fingerprint': fingerprint}
+    if test['TestId'] in reuse:
+        entry['fingerprint'] = reuse[test['TestId']].get('fingerprint', fingerprint)
+        entry['fetched'] = reuse[test['TestId']]['fetched']
+    else:
+        entry['fetched'] = now
+    for key in AGENT_COUNT_KEYS:
+        entry[key] = test[key]
+    if test.get('Monthly_usage') is not None:
+        entry['Monthly_usage'] = test['Monthly_usage']
+    return entry
+
+
+def save_report_state(te_test_dict, reuse):
+    """
+    Saves the agent counts and config fingerprint of every test for the next incremental run
+    Must be called after update_agent_count.
+    :param te_test_dict: output of update_agent_count
+    :param reuse: output of reusable_agent_counts, reused tests keep their fetch time
+    """
+    now = time.time()
+    write_report_state({str(test['TestId']): report_state_entry(test, te_test_dict['fingerprints'][test['TestId']],
+                                                                reuse, now)
+                        for test in te_test_dict['tests'] if needs_test_result(test)})
+
+
+def write_report_state(tests):
+    """
+    Writes the incremental mode state file, replacing the previous one at once
+    :param tests: state entries by test id, see report_state_entry
+    """
+    if not Incremental_State_File:
+        return
+    temp_file = f"{Incremental_State_File}.tmp"
+    with open(temp_file, 'w') as file:
+        json.dump({'tests': tests}, file)
+    os.replace(temp_file, Incremental_State_File)
+
+
+def report_columns(row):
+    """
+    Column values of a report row for the typed outputs, empty agent lists become []
+    :param row: TestRecord or dict
+    :return: dict of column -> value
+    """
+    values = dict(zip(row.keys(), row.values()))
+    for column in LIST_COLUMNS:
+        if values.get(column) == "":
+            values[column] = []
+    return values
+
+
+class CsvReportWriter:
+    """
+    Writes report rows to a CSV file, columns are the keys of the first row.
+    Each row is flushed as soon as it is written so an interrupted run leaves a partial report.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'w', newline="")
+        self.write_row = None
+
+    def write(self, row):
+        if self.write_row is None:
+            if isinstance(row, TestRecord):
+                # Records export their column values straight to the writer
+                writer = csv.writer(self.file)
+                writer.writerow(row.keys())
+                self.write_row = lambda record: writer.writerow(record.values())
+            else:
+                writer = csv.DictWriter(self.file, fieldnames=list(row.keys()))
+                writer.writeheader()
+                self.write_row = writer.writerow
+        self.write_row(row)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NdjsonReportWriter:
+    """
+    Writes report rows to a gzip compressed JSON Lines file, agent lists are JSON arrays
+    """
+
+    def __init__(self, filename):
+        import gzip
+        self.filename = filename
+        self.file = gzip.open(filename, 'wt', encoding="utf-8")
+
+    def write(self, row):
+        self.file.write(json.dumps(report_columns(row)) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetReportWriter:
+    """
+    Writes report rows to a Parquet file in batches of Parquet_Batch_Rows, agent lists are list<string> columns.
+    Needs pyarrow (pip install pyarrow).
+    """
+
+    def __init__(self, filename):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ThousandEyesError("Parquet output needs pyarrow: pip install pyarrow") from None
+        self.pyarrow = pyarrow
+        self.filename = filename
+        self.writer = None
+        self.batch = []
+
+    def write(self, row):
+        self.batch.append(report_columns(row))
+        if len(self.batch) >= Parquet_Batch_Rows:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        pa = self.pyarrow
+        if self.writer is None:
+            self.schema = pa.schema([(column, parquet_type(pa, column)) for column in self.batch[0]])
+            self.writer = pa.parquet.ParquetWriter(self.filename, self.schema)
+        columns = {}
+        for field in self.schema:
+            columns[field.name] = [parquet_value(field.type, row.get(field.name)) for row in self.batch]
+        self.writer.write_table(pa.table(columns, schema=self.schema))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            # No rows: write an empty file with the report columns, CarriedOver only exists with a Fetch_Deadline
+            pa = self.pyarrow
+            schema = pa.schema([(column, parquet_type(pa, column)) for column in REPORT_COLUMNS
+                                if column != "CarriedOver" or Fetch_Deadline])
+            pa.parquet.write_table(schema.empty_table(), self.filename)
+
+
+def parquet_type(pa, column):
+    """
+    Arrow type of a report column, unknown columns are strings
+    :param pa: pyarrow module
+    :param column:
+    :return: pyarrow.DataType
+    """
+    if column in INTEGER_COLUMNS:
+        return pa.int64()
+    if column in BOOLEAN_COLUMNS:
+        return pa.bool_()
+    if column in LIST_COLUMNS:
+        return pa.list_(pa.string())
+    return pa.string()
+
+
+def parquet_value(arrow_type, value):
+    """
+    Converts a report value to its Parquet column type, "" and "NotApplicable" become null in typed columns
+    :param arrow_type:
+    :param value:
+    :return: value
+    """
+    if str(arrow_type) == "string":
+        return None if value is None else f"{value}"
+    if value in ("", "NotApplicable"):
+        return None
+    return value
+
+
+# Output formats: file extension and writer class
+REPORT_FORMATS = {
+    "csv": (".csv", CsvReportWriter),
+    "ndjson": (".ndjson.gz", NdjsonReportWriter),
+    "parquet": (".parquet", ParquetReportWriter),
+}
+
+
+def write_report(rows, basename=None, formats=None):
+    """
+    Writes a stream of report rows to every output format at once
+    :param rows: list or iterator of TestRecords or dicts
+    :param basename: file name without extension, defaults to te_report_<date>
+    :param formats: names from REPORT_FORMATS, defaults to Report_Formats
+    :return: list of filenames, in the order of formats
+    """
+    if basename is None:
+        basename = f'te_report_{date.today()}'
+    if formats is None:
+        formats = Report_Formats
+    writers = []
+    try:
+        for name in formats:
+            extension, writer_class = REPORT_FORMATS[name]
+            writers.append(writer_class(f"{basename}{extension}"))
+        for row in rows:
+            with profile_phase("write_report"):
+                for writer in writers:
+                    writer.write(row)
+    finally:
+        for writer in writers:
+            writer.close()
+    for writer in writers:
+        print(f"OUTPUT saved in {writer.filename} file successfully")
+    return [writer.filename for writer in writers]
+
+
+def convert_to_csv(te_dict, filename=None):
+    """
+    Creates a filename.csv from a list or an iterator of rows
+    Each row is written and flushed as soon as it is produced, columns are the keys of the first row.
+    :param te_dict:
+    :param filename: defaults to te_report_<date>.csv
+    :return: filename.csv
+    """
+    if filename is None:
+        filename = f'te_report_{date.today()}.csv'
+    writer = CsvReportWriter(filename)
+    try:
+        for row in te_dict:
+            with profile_phase("write_report"):
+                writer.write(row)
+    finally:
+        writer.close()
+    print(f"OUTPUT saved in {filename} file successfully")
+    return filename
+
+
+def round_num(num):
+    """
+    Round the given float number to whole integer
+    :param float num:
+    :return: whole integer
+    """
+    s_num = str(num)
+    if '.' in s_num:
+        id = s_num.split('.')
+        if int(id[1][0]) >= 5:
+            return int(id[0]) + 1
+        else:
+            return int(id[0])
+    else:
+        return s_num
 
-# (Optional) set account group name
-Account_Group_Name = ""
 
-def get_account_id(account_name):
+def round_usage(values):
     """
-        API that returns account info
-        :return: resp
+    Vectorized round_num: rounds half up on the first decimal of each value
+    Values that str() prints in scientific notation go through round_num so the result is identical.
+    :param values: numpy float array
+    :return: list of whole integers
     """
-    try:
-        url = "https://api.thousandeyes.com/v7/account-groups"
-        headers = {"Authorization": f"Bearer {BEARER_TOKEN}", "Accept": "application/hal+json"}
-        response = requests.request('GET', url, headers=headers)
-        response.raise_for_status()
-        resp = response.json()
-        for acc in resp['accountGroups']:
-            if acc['accountGroupName'] == account_name:
-                return acc["aid"]
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-    except requests.exceptions.ConnectionError as conn_err:
-        print(f"Connection error occurred: {conn_err}")
-    except requests.exceptions.Timeout as timeout_err:
-        print(f"Timeout error occurred: {timeout_err}")
-    except requests.exceptions.RequestException as req_err:
-        print(f"Request error occurred: {req_err}")
-    except Exception as err:
-        print(f"An error occurred: {err}")
-    return ""
+    import numpy as np
+    floor = np.floor(values)
+    irregular = np.flatnonzero((values != 0) & ((values < 1e-4) | (values >= 1e16)))
+    rounded = np.where(values - floor >= 0.5, floor + 1, floor)
+    rounded[irregular] = 0
+    rounded = rounded.astype(np.int64).tolist()
+    for i in irregular:
+        rounded[i] = round_num(float(values[i]))
+    return rounded
 
-def get_te_tests(aid):
+
+def usage_units(unit, runs, agents, multiplier=1.0):
     """
-    API that returns configured tests and saved events.
-    :return: resp
+    Thousands of units used in a month by agents running a test
+    :param unit: units per agent and test round
+    :param runs: test rounds per hour, 60 / interval in minutes
+    :param agents: number of agents
+    :param multiplier: per type multiplier ex: page load timeout
+    :return: usage, same shape as the inputs
     """
+    return (unit * multiplier * runs * 24 * 31 * agents) / 1000
 
-    try:
-        url = "https://api.thousandeyes.com/v7/tests"
-        payload = None
-        params = {"aid": f"{aid}"}
-        headers = {"Authorization": f"Bearer {BEARER_TOKEN}", "Accept": "application/hal+json"}
-        response = requests.request('GET', url, headers=headers, data=payload, params=params)
-        response.raise_for_status()
-        resp = response.json()
-        temp_te_test_list = []
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        sys.exit()
-    except requests.exceptions.ConnectionError as conn_err:
-        print(f"Connection error occurred: {conn_err}")
-        sys.exit()
-    except requests.exceptions.Timeout as timeout_err:
-        print(f"Timeout error occurred: {timeout_err}")
-        sys.exit()
-    except requests.exceptions.RequestException as req_err:
-        print(f"Request error occurred: {req_err}")
-        sys.exit()
-    except Exception as err:
-        print(f"An error occurred: {err}")
-        sys.exit()
-
-    # Loop through each test and create a list of dicts
-    for test in resp['tests']:
-        test_dict = {}
-        test_dict["TestId"] = test['testId']
-        test_dict["TestName"] = test['testName']
-        test_dict["TeShared"] = test['liveShare']
-
-        # Test Type
-        if test['type'] == 'voice':
-            test_dict["TestType"] = 'rtp-server'
-        else:
-            test_dict["TestType"] = test['type']
-        if 'targetAgentId' in test.keys():
-            test_dict["targetAgentId"] = test['targetAgentId']
-        else:
-            test_dict["targetAgentId"] = "NotApplicable"
-        # Interval
-        if 'interval' in test:
-            test_dict["Interval"] = test['interval']
-        else:
-            test_dict["Interval"] = ""
 
-        test_dict["AlertsEnabled"] = test['alertsEnabled']
-        test_dict["Enabled"] = test['enabled']
+def agent_to_agent_usage(runs, cloud_agents, ent_agents, target_enterprise, target_cloud, bidirectional,
+                         from_target):
+    """
+    Unrounded usage of agent-to-agent tests without throughput measurements
+    :param runs: test rounds per hour
+    :param cloud_agents:
+    :param ent_agents:
+    :param target_enterprise: target agent type is enterprise
+    :param target_cloud: target agent type is cloud
+    :param bidirectional: direction is bidirectional
+    :param from_target: direction is from-target
+    :return: numpy float array
+    """
+    import numpy as np
+    cloud_unit = Units["Agent_to_Agent"]["CloudAgent"]
+    ent_unit = Units["Agent_to_Agent"]["EntAgent"]
+    cloud_usage = usage_units(cloud_unit, runs, cloud_agents)
+    ent_usage = usage_units(ent_unit, runs, ent_agents)
+    target_usage = np.where(target_enterprise, usage_units(ent_unit, runs, cloud_agents + ent_agents),
+                            usage_units(cloud_unit, runs, cloud_agents + ent_agents))
 
-        # Protocol
-        if 'protocol' in test:
-            test_dict["Protocol"] = test['protocol']
-        else:
-            test_dict["Protocol"] = ""
+    # Bidirectional: the target agent also runs the test towards every source agent
+    no_cloud = np.where(target_cloud, usage_units(cloud_unit, runs, 1) * ent_agents + ent_usage, ent_usage * 2)
+    no_ent = np.where(target_enterprise, cloud_usage + usage_units(ent_unit, runs, 1) * cloud_agents,
+                      cloud_usage * 2)
+    both = cloud_usage + ent_usage + target_usage
+    bidirectional_usage = np.where(cloud_agents == 0, no_cloud, np.where(ent_agents == 0, no_ent, both))
 
-        # Created By
-        if "createdBy" in test:
-            test_dict["CreatedBy"] = test['createdBy']
-        else:
-            test_dict["CreatedBy"] = "unknown"
+    one_way_usage = np.where(from_target, target_usage, cloud_usage + ent_usage)
+    return np.where(bidirectional, bidirectional_usage, one_way_usage)
 
-        # Created Date
-        if "createdDate" in test:
-            test_dict["CreatedDate"] = test['createdDate']
-        else:
-            test_dict["CreatedDate"] = "unknown"
-
-        # Target
-        if test['type'] == 'dns-server' or test['type'] == 'dns-trace' or test['type'] == 'dnssec':
-            test_dict["Target"] = test['domain']
-        elif test['type'] == 'agent-to-server':
-            test_dict["Target"] = test['server']
-        elif (test['type'] == 'page-load' or test['type'] == 'http-server' or test['type'] == 'api'
-              or test['type'] == 'web-transactions' or test['type'] == 'ftp-server'):
-            test_dict["Target"] = test['url']
-        elif test['type'] == 'agent-to-agent' or test['type'] == 'voice':
-            agent_name = agent_id_to_agent_name(test['targetAgentId'])
-            test_dict["Target"] = agent_name
-        elif test['type'] == 'bgp':
-            test_dict["Target"] = test['prefix']
-        elif test['type'] == 'sip-server':
-            test_dict["Target"] = test['sipRegistrar'] + ':' + str(test['port'])
-        else:
-            test_dict["Target"] = 'unknown'
 
-        # Amount of DNS servers check
-        if test['type'] == 'dns-server':
-            test_dict['servers'] = len(test['dnsServers'])
-        else:
-            test_dict['servers'] = "NotApplicable"
+def calculate_monthly_usage(tests):
+    """
+    Calculates the monthly usage of every test at once from the Units rate table
+    :param tests: test dicts with agent counts, see update_agent_count
+    :return: list of Monthly_usage values in the order of tests
+    """
+    if not tests:
+        return []
+    import numpy as np
 
-        # Time Load Limit
-        if test['type'] == 'page-load':
-            test_dict['timeout'] = test['pageLoadTimeLimit']
-        elif test['type'] == "http-server":
-            test_dict['timeout'] = test["httpTimeLimit"]
-        elif test['type'] == "api":
-            test_dict['timeout'] = test["timeLimit"]
-        elif test['type'] == "web-transactions":
-            test_dict['timeout'] = test["timeLimit"]
-        elif test['type'] == "sip-server":
-            test_dict['timeout'] = test["sipTimeLimit"]
-        elif test['type'] == "ftp-server":
-            test_dict['timeout'] = test["ftpTimeLimit"]
+    # Columns of the pricing fields, unpriced tests get neutral values
+    kinds, interval, cloud_agents, ent_agents, cloud_unit, ent_unit, multiplier = [], [], [], [], [], [], []
+    for test in tests:
+        name = UNIT_BY_TEST_TYPE.get(test["TestType"]) if test["TeShared"] == False else None
+        cloud_agents.append(test["CloudAgents"])
+        ent_agents.append(test["EnterpriseAgent"])
+        if name is None or name == "BGP":
+            kinds.append(USAGE_BGP if name == "BGP" else USAGE_NONE)
+            interval.append(60)
+            cloud_unit.append(0)
+            ent_unit.append(0)
+            multiplier.append(1)
+            continue
+        if name != "Agent_to_Agent":
+            kinds.append(USAGE_TABLE)
+        elif test["Throughput"] == False:
+            kinds.append(USAGE_A2A_LATENCY)
+        elif test["Throughput"] == True:
+            kinds.append(USAGE_A2A_THROUGHPUT)
         else:
-            test_dict['timeout'] = "NotApplicable"
+            kinds.append(USAGE_NONE)
+        unit = Units[name]
+        interval.append(test["Interval"])
+        cloud_unit.append(unit["CloudAgent"])
+        ent_unit.append(unit["EntAgent"])
+        multiplier.append(test[unit["Multiplier"]] if unit["Multiplier"] else 1)
 
-        # Duration
-        if test['type'] == "voice":
-            test_dict["duration"] = test["duration"]
-        else:
-            test_dict["duration"] = "NotApplicable"
+    kinds = np.array(kinds, dtype=np.int8)
+    priced = (kinds == USAGE_TABLE) | (kinds == USAGE_A2A_LATENCY)
+    latency = kinds == USAGE_A2A_LATENCY
+    throughput = kinds == USAGE_A2A_THROUGHPUT
+    bgp = kinds == USAGE_BGP
+    runs = 60 / (np.array(interval, dtype=float) / 60)
+    cloud_agents = np.array(cloud_agents, dtype=float)
+    ent_agents = np.array(ent_agents, dtype=float)
+    cloud_unit = np.array(cloud_unit, dtype=float)
+    ent_unit = np.array(ent_unit, dtype=float)
+    multiplier = np.array(multiplier, dtype=float)
 
-        # Throughput
-        if test['type'] == "agent-to-agent":
-            test_dict["Throughput"] = test["throughputMeasurements"]
-            test_dict["direction"] = test["direction"]
-            if "throughputDuration" in test.keys():
-                test_dict["ThroughputDuration"] = test["throughputDuration"]
-            else:
-                test_dict["ThroughputDuration"] = "NotApplicable"
-        else:
-            test_dict["Throughput"] = "NotApplicable"
-            test_dict["direction"] = "NotApplicable"
-            test_dict["ThroughputDuration"] = "NotApplicable"
+    # Every type in the rate table: cloud and enterprise agents priced separately
+    usage = usage_units(cloud_unit, runs, cloud_agents, multiplier) + usage_units(ent_unit, runs, ent_agents,
+                                                                                  multiplier)
 
-        temp_te_test_list.append(test_dict)  # append the test dict to a list
+    # Agent-to-agent latency tests depend on direction and on the type of the target agent
+    if latency.any():
+        rows = np.flatnonzero(latency)
+        target_types = [target_agent_type(tests[i]) for i in rows]
+        direction = [tests[i]["direction"] for i in rows]
+        usage[rows] = agent_to_agent_usage(
+            runs[rows], cloud_agents[rows], ent_agents[rows],
+            np.array([agent_type == "enterprise" for agent_type in target_types]),
+            np.array([agent_type == "cloud" for agent_type in target_types]),
+            np.array([value == "bidirectional" for value in direction]),
+            np.array([value == "from-target" for value in direction]))
+    monthly_usage = round_usage(np.where(priced, usage, 0.0))
 
-    resp.update({'tests': temp_te_test_list})  # update the dict with the list of test dicts
-    return resp
+    # Agent-to-agent throughput tests: only enterprise agents, twice when bidirectional
+    if throughput.any():
+        unit = Units["Agent_to_Agent_TE"]
+        rows = np.flatnonzero(throughput)
+        duration = np.array([int(tests[i][unit["Multiplier"]]) if unit["Multiplier"] else 1 for i in rows]) \
+            / unit.get("MultiplierScale", 1)
+        rounds = np.array([2 if tests[i]["direction"] == "bidirectional" else 1 for i in rows])
+        ent_usage = (unit["EntAgent"] * duration * runs[rows] * 24 * 31 * ent_agents[rows]) * rounds / 1000
+        for i, value in zip(rows.tolist(), round_usage(ent_usage)):
+            monthly_usage[i] = value
 
+    # BGP tests: fixed units at a fixed interval, whatever their agents
+    unit = Units["BGP"]
+    bgp_usage = round_num(unit["CloudAgent"] * (60 / (unit["Interval"] / 60) * 24 * 31) / 1000)
+    for i in np.flatnonzero(bgp).tolist():
+        monthly_usage[i] = bgp_usage
+    return monthly_usage
 
-def get_te_test_result(test_id, test_type):
+
+def target_agent_type(test):
     """
-    Returns network test results for every agent and round.
-    If you do not specify a window or a start and end date, data is displayed for the most recent testing round.
+    Type of the target agent of an agent-to-agent test, from a pricing config or the agent directory
+    :param test: test dict or pricing config, see pricing_config
+    :return: agent type ex: enterprise, cloud
+    """
+    if isinstance(test, dict) and "targetAgentType" in test:
+        return test["targetAgentType"]
+    return get_agent_type(test['targetAgentId'])
+
+
+def pricing_config(test):
+    """
+    Pricing fields of a test as a plain dict, the input of price_tests.
+    The target agent type of agent-to-agent tests is resolved now, so pricing needs no API request later.
+    :param test: test dict with agent counts, see update_agent_count
+    :return: dict with the PRICING_FIELDS ex: {'TestType': 'http-server', 'Interval': 300, 'CloudAgents': 2, ...}
+    """
+    config = {field: test.get(field, "NotApplicable") for field in PRICING_FIELDS[:-1]}
+    if test["TestType"] == "agent-to-agent":
+        config["targetAgentType"] = target_agent_type(test)
+    else:
+        config["targetAgentType"] = "NotApplicable"
+    return config
+
+
+def pricing_key(config):
+    """
+    Hashable form of a pricing config, the fields missing from the config get their defaults
+    :param config: see pricing_config
+    :return: tuple in the order of PRICING_FIELDS
+    """
+    return tuple(config.get(field, False if field == "TeShared" else "NotApplicable") for field in PRICING_FIELDS)
+
+
+def price_keys(keys, memo):
+    """
+    Prices the pricing keys missing from memo at once, see calculate_monthly_usage
+    :param keys: iterable of pricing keys, see pricing_key
+    :param memo: dict of pricing key -> Monthly_usage, updated
+    """
+    missing = list(dict.fromkeys(key for key in keys if key not in memo))
+    if missing:
+        tests = [dict(zip(PRICING_FIELDS, key)) for key in missing]
+        memo.update(zip(missing, calculate_monthly_usage(tests)))
+
+
+def price_tests(configs, memo=None):
+    """
+    Monthly usage of pricing configs, without API requests and without changing the configs.
+    Gives the same Monthly_usage as calculate_usage_manual for the same tests.
+    :param configs: pricing configs, see pricing_config; TeShared defaults to False, other fields to NotApplicable
+    :param memo: dict of pricing key -> Monthly_usage kept between calls, identical configs are priced once
+    :return: list of Monthly_usage values in the order of configs
+    """
+    if memo is None:
+        memo = {}
+    keys = [pricing_key(config) for config in configs]
+    price_keys(keys, memo)
+    return [memo[key] for key in keys]
+
+
+def price_scenarios(configs, scenarios, test_types=None, memo=None):
+    """
+    What-if pricing: monthly usage of the configs under every scenario.
+    A scenario overrides pricing fields of the tests of test_types, ex: every HTTP test at a 5 vs 15 minute interval:
+    price_scenarios(configs, [{'Interval': 300}, {'Interval': 900}], test_types=['http-server'])
+    Each distinct config is priced once for all scenarios, in a single vectorized batch.
+    :param configs: pricing configs, see pricing_config and history_pricing_configs
+    :param scenarios: list of dicts of pricing fields, see scenario_grid
+    :param test_types: test types the scenarios apply to, None for every test
+    :param memo: dict of pricing key -> Monthly_usage kept between calls, see price_tests
+    :return: list of dicts ex: [{'scenario': {'Interval': 300}, 'Monthly_usage': 123456, 'tests': [2120, ...]}]
+    """
+    if memo is None:
+        memo = {}
+    # Tests are priced through their distinct configs, identical tests share one
+    distinct = {}
+    positions = [distinct.setdefault(pricing_key(config), len(distinct)) for config in configs]
+    distinct = list(distinct)
+    affected = [i for i, key in enumerate(distinct) if test_types is None or key[0] in test_types]
+
+    # Affected distinct configs under each scenario
+    scenario_keys = []
+    for scenario in scenarios:
+        overrides = [(PRICING_FIELDS.index(field), value) for field, value in scenario.items()]
+        changed_keys = []
+        for i in affected:
+            key = list(distinct[i])
+            for position, value in overrides:
+                key[position] = value
+            changed_keys.append(tuple(key))
+        scenario_keys.append(changed_keys)
+    price_keys(itertools.chain(distinct, *scenario_keys), memo)
+    base_usage = [memo[key] for key in distinct]
+
+    results = []
+    for scenario, changed_keys in zip(scenarios, scenario_keys):
+        distinct_usage = list(base_usage)
+        for i, key in zip(affected, changed_keys):
+            distinct_usage[i] = memo[key]
+        usage = [distinct_usage[position] for position in positions]
+        results.append({'scenario': scenario, 'Monthly_usage': sum(usage), 'tests': usage})
+    return results
+
+
+def scenario_grid(**values):
+    """
+    Every combination of pricing field values, the scenarios of price_scenarios
+    :param values: values of each field ex: Interval=[300, 900], CloudAgents=[2, 4]
+    :return: list of dicts ex: [{'Interval': 300, 'CloudAgents': 2}, {'Interval': 300, 'CloudAgents': 4}, ...]
+    """
+    return [dict(zip(values, combination)) for combination in itertools.product(*values.values())]
+
+
+def calculate_usage_manual(tests):
+    """
+    function calculates cost for all the tests
+    :param tests:
+    :return: tests with cost calculated
+    """
+    with profile_phase("pricing"):
+        for test, monthly_usage in zip(tests["tests"], calculate_monthly_usage(tests["tests"])):
+            test["Monthly_usage"] = monthly_usage
+            # Records only export report columns, plain dicts drop their pricing fields
+            if isinstance(test, dict):
+                for key in PRICING_KEYS:
+                    del test[key]
+    return tests
+
+def iter_report_rows(te_test_dict, enterprise_agent_dict, max_workers=None, reuse=None, state=None, journal=None,
+                     carry=None, deadline=None, aid=""):
+    """
+    Report pipeline: yields each finished report row as soon as its test results are fetched and priced.
+    The rows whose agents are already counted are priced together, see iter_agent_count_batches
+    :param te_test_dict: output of get_te_tests
+    :param enterprise_agent_dict:
+    :param max_workers: number of concurrent test result requests, None for Max_Workers adapted to the API
+    :param reuse: agent counts by test id to use instead of fetching the test results, see reusable_agent_counts
+    :param state: dict filled with the incremental mode state entry of every test, see report_state_entry
+    :param journal: open checkpoint journal every finished row is appended to, see open_journal
+    :param carry: previous state entries kept after the deadline, see iter_agent_count_batches
+    :param deadline: time.monotonic() after which the tests in carry are not fetched, None for no deadline
+    :param aid: account group id of the tests, "" for the default account group
+    :return: generator of report rows
+    """
+    if reuse is None:
+        reuse = {}
+    now = time.time()
+    for batch in iter_agent_count_batches(te_test_dict['tests'], enterprise_agent_dict, max_workers, reuse, carry,
+                                          deadline, aid):
+        calculate_usage_manual({'tests': batch})
+        for test in batch:
+            checkpoint_row(test, te_test_dict['fingerprints'], reuse, now, state, journal)
+            yield test
+
+
+def test_priority(test, fingerprint, previous):
+    """
+    Sort key of a test in the fetch order of Priority_Scheduling, the most expected impact first:
+    new tests and tests whose config changed, then the highest previous Monthly_usage times the Test_Type_Weights
+    weight of the test type. Tests without test results to fetch come last.
+    :param test: test dict
+    :param fingerprint: see test_fingerprint
+    :param previous: state entry of the test in the previous incremental run, see load_report_state, None if new
+    :return: tuple, lower first
+    """
+    if not needs_test_result(test):
+        return 2, 0
+    changed = previous is None or previous['fingerprint'] != fingerprint
+    usage = (previous or {}).get('Monthly_usage') or 0
+    return 0 if changed else 1, -usage * Test_Type_Weights.get(test['TestType'], 1)
+
+
+def iter_scheduled_report_rows(te_test_dict, enterprise_agent_dict, previous_state=None, reuse=None, state=None,
+                               journal=None, deadline=None, aid=""):
+    """
+    Report pipeline fetching the test results by priority instead of in the order of the tests, see test_priority.
+    Rows are yielded in the order of the tests once every test is done.
+    :param te_test_dict: tests and fingerprints, see get_te_tests
+    :param enterprise_agent_dict:
+    :param previous_state: output of load_report_state, the previous usage and the agent counts kept after the deadline
+    :param reuse: agent counts by test id to use instead of fetching the test results, see reusable_agent_counts
+    :param state: dict filled with the incremental mode state entry of every test, see report_state_entry
+    :param journal: open checkpoint journal, see open_journal
+    :param deadline: time.monotonic() after which tests with previous agent counts are not fetched
+    :param aid: account group id of the tests, "" for the default account group
+    :return: generator of report rows
+    """
+    previous = previous_state['tests'] if previous_state else {}
+    tests = list(te_test_dict['tests'])
+    fingerprints = te_test_dict['fingerprints']
+    order = sorted(tests, key=lambda test: test_priority(test, fingerprints[test['TestId']],
+                                                         previous.get(str(test['TestId']))))
+    for _ in iter_report_rows({'tests': order, 'fingerprints': fingerprints}, enterprise_agent_dict, reuse=reuse,
+                              state=state, journal=journal, carry=previous, deadline=deadline, aid=aid):
+        pass
+    yield from tests
+
+
+def checkpoint_row(test, fingerprints, reuse, now, state, journal):
+    """
+    Saves the incremental mode state entry of a finished row and appends the row to the checkpoint journal
+    :param test: priced report row
+    :param fingerprints: config fingerprint of each test id, see iter_te_tests
+    :param reuse: agent counts by test id that were not fetched, see reusable_agent_counts
+    :param now: fetch time of the rows that were fetched
+    :param state: dict filled with the incremental mode state entry of every test, None to keep no state
+    :param journal: open checkpoint journal, None to keep no journal
+    """
+    fetched = reuse[test['TestId']]['fetched'] if test['TestId'] in reuse else now
+    if state is not None and needs_test_result(test):
+        state[str(test['TestId'])] = report_state_entry(test, fingerprints[test['TestId']], reuse, now)
+    if journal is not None:
+        with profile_phase("write_journal"):
+            journal.write(json.dumps({'fetched': fetched, 'row': test}, default=TestRecord.as_dict) + "\n")
+            journal.flush()
+
+
+def get_te_test_result_body(test_id, test_type, params=None):
+    """
+    Returns the undecoded response of get_te_test_result, so a transform process decodes it.
     :param test_id:
     :param test_type:
-    :return: resp
+    :param params: query parameters selecting the rounds
+    :return: json response body as bytes
     """
+    path = f"/v7/test-results/{test_id}/{test_type}"
+    if Record_File or (get_cache() is not None and cache_ttl(path) > 0):
+        return json.dumps(get_te_test_result(test_id, test_type, params)).encode()
+    # Bodies can be large, they are only shared with identical requests in flight
+    return single_flight(("body", record_key(path, params)), lambda: send_request(path, params or None).content,
+                         keep=False)
 
-    try:
-        url = f"https://api.thousandeyes.com/v7/test-results/{test_id}/{test_type}?window=2m"
-        payload = None
-        headers = {"Authorization": f"Bearer {BEARER_TOKEN}", "Accept": "application/hal+json"}
-        response = requests.request('GET', url, headers=headers, data=payload)
-        response.raise_for_status()
-        resp = response.json()
-        return resp
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        sys.exit()
-    except requests.exceptions.ConnectionError as conn_err:
-        print(f"Connection error occurred: {conn_err}")
-        sys.exit()
-    except requests.exceptions.Timeout as timeout_err:
-        print(f"Timeout error occurred: {timeout_err}")
-        sys.exit()
-    except requests.exceptions.RequestException as req_err:
-        print(f"Request error occurred: {req_err}")
-        sys.exit()
-    except Exception as err:
-        print(f"An error occurred: {err}")
-        sys.exit()
+
+def init_transform_process(settings):
+    """
+    Initializer of the transform processes
+    :param settings: values of TRANSFORM_SETTINGS in the report process
+    """
+    globals().update(settings)
 
 
-def get_enterprise_agent_list():
+def get_transform_pool():
     """
-    Returns a list of all Enterprise agents available to your ThousandEyes account,
-    including both Enterprise and Cluster.
-    :return: enterprise agents id list Ex:[12345, 67890]
+    Returns the pool of Transform_Processes processes, starting it on first use.
+    Every account group shares the pool.
+    :return: concurrent.futures.ProcessPoolExecutor
     """
+    global transform_pool
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    with transform_pool_lock:
+        if transform_pool is None:
+            # Spawned, not forked: a forked child could inherit a lock held by a fetch thread and hang on it
+            transform_pool = ProcessPoolExecutor(
+                max_workers=Transform_Processes, mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_transform_process,
+                initargs=({name: globals()[name] for name in TRANSFORM_SETTINGS},))
+        return transform_pool
 
-    try:
-        url = "https://api.thousandeyes.com/v7/agents"
-        payload = {}
-        params = {"agentTypes": ["enterprise-cluster", "enterprise"]}
-        headers = {"Authorization": f"Bearer {BEARER_TOKEN}", "Accept": "application/hal+json"}
-        response = requests.request('GET', url, headers=headers, data=payload, params=params)
-        response.raise_for_status()
-        resp = response.json()
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        sys.exit()
-    except requests.exceptions.ConnectionError as conn_err:
-        print(f"Connection error occurred: {conn_err}")
-        sys.exit()
-    except requests.exceptions.Timeout as timeout_err:
-        print(f"Timeout error occurred: {timeout_err}")
-        sys.exit()
-    except requests.exceptions.RequestException as req_err:
-        print(f"Request error occurred: {req_err}")
-        sys.exit()
-    except Exception as err:
-        print(f"An error occurred: {err}")
-        sys.exit()
 
-    ent_agent_ids = []
-    for agents in resp['agents']:
-        ent_agent_ids.append(agents['agentId'])
+def transform_batch(batch, aid, agents):
+    """
+    Transform stage, run in a transform process: converts a batch of tests, counts their agents and prices them.
+    :param batch: list of (test as returned by /v7/tests, test results response body or None,
+                  agent counts to reuse or None), see iter_transformed_rows
+    :param aid: account group id, "" for the default account group
+    :param agents: the agents the batch needs, {'enterprise': set of enterprise agent ids,
+                   'names': {target agent id: name}, 'types': {target agent id: type}}
+    :return: list of priced report rows
+    """
+    global agent_directory
+    agent_directory = dict(agents, account_groups={aid})
+    rows = []
+    for test, body, reused in batch:
+        row = convert_test(test, aid)
+        set_test_agents(row, agents['enterprise'], reused,
+                        lambda: get_agent_count(json.loads(body)['results'], agents['enterprise']))
+        rows.append(row)
+    calculate_usage_manual({'tests': rows})
+    return rows
 
-    return ent_agent_ids
 
-def get_agent_type(agent_Id):
+def raw_test_fields(test):
     """
-    Find the type of agent 
-    :return: agent type , cloud or enterprise
+    Fields of convert_test read from a test of /v7/tests before it is converted, for the test results request and
+    test_priority
+    :param test: test of the API
+    :return: dict with TestId, TestType, Enabled and Interval
     """
-    try:
-        url = "https://api.thousandeyes.com/v7/agents"
-        payload = {}
-        headers = {"Authorization": f"Bearer {BEARER_TOKEN}", "Accept": "application/hal+json"}
-        response = requests.request('GET', url, headers=headers, data=payload)
-        resp = response.json()
-        for agent in resp["agents"]:
-            if agent["agentId"] == agent_Id:
-                return agent["agentType"]
-        else:
-            return "NotApplicable"
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        sys.exit()
-    except requests.exceptions.ConnectionError as conn_err:
-        print(f"Connection error occurred: {conn_err}")
-        sys.exit()
-    except requests.exceptions.Timeout as timeout_err:
-        print(f"Timeout error occurred: {timeout_err}")
-        sys.exit()
-    except requests.exceptions.RequestException as req_err:
-        print(f"Request error occurred: {req_err}")
-        sys.exit()
-    except Exception as err:
-        print(f"An error occurred: {err}")
-        sys.exit()
+    return {'TestId': test['testId'], 'TestType': 'rtp-server' if test['type'] == 'voice' else test['type'],
+            'Enabled': test['enabled'], 'Interval': test.get('interval', "")}
 
-def get_agent_count(test_result, enterprise_agent_list):
+
+def iter_transformed_rows(aid, previous_state=None, state=None, journal=None, reuse=None, max_workers=None,
+                          scheduled=False, deadline=None):
     """
-    Finds the number of agents and locations for a test
-    :param test_result:
-    :param enterprise_agent_list:
-    :return: TE dict with ex: CloudAgents: 2, CloudAgentList: ['San Francisco, CA', 'New York, NY']
+    Report pipeline of one account group with the transform stage in Transform_Processes processes.
+    Threads of this process receive the tests and the undecoded test results, the processes convert, count and
+    price them by Transform_Batch_Size tests. Yields the same rows as iter_report_rows, in the order of the tests.
+    Account groups only share the test results of a test while it is requested, see get_te_test_result_body.
+    :param aid: account group id, "" for the default account group
+    :param previous_state: output of load_report_state, unchanged tests reuse their agent counts
+    :param state: dict filled with the incremental mode state entry of every test, see report_state_entry
+    :param journal: open checkpoint journal, see open_journal
+    :param reuse: agent counts by test id to use instead of fetching the test results, see reusable_agent_counts
+    :param max_workers: number of concurrent test result requests, None for Max_Workers adapted to the API,
+                        see test_result_concurrency
+    :param scheduled: fetch the test results by priority, see iter_scheduled_report_rows
+    :param deadline: time.monotonic() after which tests with previous agent counts are not fetched, see
+                     iter_agent_counts
+    :return: generator of report rows
     """
+    max_workers, limiter = test_result_concurrency(max_workers)
+    limit = limiter.request if limiter is not None else nullcontext
+    if reuse is None:
+        reuse = {}
+    enterprise_agent_list = get_enterprise_agent_list(aid)
+    pool = get_transform_pool()
+    fingerprints = {}
+    now = time.time()
+    carry = previous_state['tests'] if previous_state else {}
+    carried = set()
+    scheduled = scheduled or deadline is not None
 
-    # Create temp lists
-    cloud_agent_id_list = []
-    cloud_agent_name_list = []
+    def fetch(test):
+        fields = raw_test_fields(test)
+        with limit():
+            return get_te_test_result_body(test['testId'], get_result_test_type(fields),
+                                           test_result_params(fields, aid))
 
-    ent_agent_id_list = []
-    ent_agent_name_list = []
+    def ship(batch):
+        # Sends the oldest tests to a transform process once their test results are received
+        names = {}
+        for test, _ in batch:
+            if 'targetAgentId' in test:
+                names[test['targetAgentId']] = agent_id_to_agent_name(test['targetAgentId'], aid)
+        with profile_phase("fetch_test_results"):
+            items = [(test, body.result() if body is not None else None, reuse.get(test['testId']))
+                     for test, body in batch]
+        types = get_agent_directory(aid)['types']
+        agents = {'enterprise': enterprise_agent_list, 'names': names,
+                  'types': {agent_id: types[agent_id] for agent_id in names if agent_id in types}}
+        return pool.submit(transform_batch, items, aid, agents)
 
-    for result in test_result:
-        # Check to see if the agent is an enterprise agent
-        if result['agent']['agentId'] in enterprise_agent_list:
-            # If enterprise agent is not already added: append to the list
-            if result['agent']['agentId'] not in ent_agent_id_list:
-                ent_agent_id_list.append(result['agent']['agentId'])
-                ent_agent_name_list.append(result['agent']['agentName'])
-        # If cloud agent is not already added: append to the list
-        elif result['agent']['agentId']not in cloud_agent_id_list:
-            cloud_agent_id_list.append(result['agent']['agentId'])
-            cloud_agent_name_list.append(result['agent']['agentName'])
-
-    # Counts the number of agents
-    cloud_agent_count = int(len(cloud_agent_id_list))
-    ent_agent_count = int(len(ent_agent_id_list))
+    def finish(shipped):
+        with profile_phase("transform"):
+            rows = shipped.result()
+        for row in rows:
+            if deadline is not None:
+                row["CarriedOver"] = row['TestId'] in carried
+            checkpoint_row(row, fingerprints, reuse, now, state, journal)
+        return rows
 
-    # Format the cloud and enterprise agents data
-    agent = {'agent_count': cloud_agent_count, 'agent_ids': cloud_agent_id_list, 'agent_names': cloud_agent_name_list,
-             'e_agent_count': ent_agent_count, 'e_agent_ids': ent_agent_id_list, 'e_agent_names': ent_agent_name_list}
+    def fingerprint(test):
+        test_id = test['testId']
+        fingerprints[test_id] = test_fingerprint(test)
+        if previous_state and test_id not in reuse:
+            previous = reusable_state_entry(test_id, fingerprints[test_id], previous_state, now)
+            if previous is not None:
+                reuse[test_id] = previous
 
-    return agent
+    tests = api_get_pages("/v7/tests", 'tests', params={"aid": f"{aid}"})
+    if scheduled:
+        with profile_phase("fetch_tests"):
+            tests = list(tests)
+        for test in tests:
+            fingerprint(test)
+        listed = [test['testId'] for test in tests]
+        tests = iter(sorted(tests, key=lambda test: test_priority(raw_test_fields(test), fingerprints[test['testId']],
+                                                                  carry.get(str(test['testId'])))))
+
+    def iter_rows():
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            batches = deque()
+            while True:
+                with profile_phase("fetch_tests"):
+                    test = next(tests, None)
+                if test is None:
+                    break
+                test_id = test['testId']
+                if not scheduled:
+                    fingerprint(test)
+                # Same tests as iter_agent_counts: enabled, not bgp, no agents in the config and not reused
+                counted = (test['enabled'] and test['type'] != 'bgp' and test_id not in reuse
+                           and not (Use_Test_Config_Agents and test.get('agents')))
+                if (counted and deadline is not None and str(test_id) in carry
+                        and time.monotonic() >= deadline):
+                    reuse[test_id] = carry[str(test_id)]
+                    carried.add(test_id)
+                    counted = False
+                pending.append((test, executor.submit(fetch, test) if counted else None))
+                # Test results are requested up to 2 * max_workers tests ahead of the oldest batch
+                if len(pending) >= Transform_Batch_Size + 2 * max_workers:
+                    batches.append(ship([pending.popleft() for _ in range(Transform_Batch_Size)]))
+                if len(batches) > 2 * Transform_Processes:
+                    yield from finish(batches.popleft())
+            while pending:
+                batches.append(ship([pending.popleft() for _ in range(min(Transform_Batch_Size, len(pending)))]))
+            while batches:
+                yield from finish(batches.popleft())
 
+    if not scheduled:
+        yield from iter_rows()
+        return
+    # Rows in the order of the tests once every test is done
+    rows = {row['TestId']: row for row in iter_rows()}
+    for test_id in listed:
+        yield rows[test_id]
 
-def agent_id_to_agent_name(agent_id):
+
+def load_journal(aid):
     """
-    Returns the name of an agent based on the agent id.
-    :param agent_id:
-    :return: agentName ex:12345 -> San Jose, CA
+    Reads the rows finished by an interrupted run of the same account group
+    :param aid: account group id of this run
+    :return: dict of test id -> {'fetched': time, 'CloudAgents': 2, ...}, empty when there is nothing to resume
+    """
+    if not os.path.exists(Journal_File):
+        return {}
+    completed = {}
+    with open(Journal_File) as file:
+        header = file.readline()
+        if not header or json.loads(header).get('aid') != f"{aid}":
+            return {}
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # last line cut by the interruption
+            completed[entry['row']['TestId']] = dict(entry['row'], fetched=entry['fetched'])
+    return completed
+
+
+def open_journal(aid, resume):
+    """
+    Opens the checkpoint journal, keeping the rows of the interrupted run when resuming
+    :param aid: account group id of this run
+    :param resume: append to the existing journal instead of starting a new one
+    :return: open file
+    """
+    if resume and load_journal(aid):
+        return open(Journal_File, 'a')
+    journal = open(Journal_File, 'w')
+    journal.write(json.dumps({'aid': f"{aid}"}) + "\n")
+    journal.flush()
+    return journal
+
+
+def open_history():
+    """
+    Opens the usage history, creating its tables on first use.
+    Test configs are stored once per distinct config, the usage of every run references them.
+    The rollups by test type and owner are summed when a run is saved, see usage_rollup.
+    One connection per call, so account groups reported concurrently never share a transaction.
+    :return: sqlite3.Connection
+    """
+    import sqlite3
+    connection = sqlite3.connect(History_File, timeout=60)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS usage (
+            run_date TEXT NOT NULL, aid TEXT NOT NULL, test_id INTEGER NOT NULL, test_name TEXT, test_type TEXT,
+            created_by TEXT, cloud_agents INTEGER, enterprise_agents INTEGER, monthly_usage INTEGER, config_id TEXT,
+            PRIMARY KEY (run_date, aid, test_id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS usage_test ON usage (test_id, run_date);
+        CREATE TABLE IF NOT EXISTS configs (config_id TEXT PRIMARY KEY, config TEXT NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS rollups (
+            run_date TEXT NOT NULL, aid TEXT NOT NULL, by_column TEXT NOT NULL, key TEXT, tests INTEGER,
+            monthly_usage INTEGER, cloud_agents INTEGER, enterprise_agents INTEGER,
+            PRIMARY KEY (by_column, run_date, aid, key)) WITHOUT ROWID;
+    """)
+    return connection
+
+
+def iter_history(rows, aid, run_date=None):
+    """
+    Passes report rows through and saves them as the run_date snapshot of the usage history once all rows are done.
+    A second run on the same day replaces the snapshot of that day.
+    :param rows: report rows
+    :param aid: account group id, "" for the default account group
+    :param run_date: ISO date of the snapshot, defaults to today
+    :return: generator of report rows
     """
+    if run_date is None:
+        run_date = date.today().isoformat()
+    snapshot = []
+    configs = {}
+    rollups = {}
+    for row in rows:
+        config = {column: value for column, value in report_columns(row).items()
+                  if column not in HISTORY_USAGE_COLUMNS and column != "CarriedOver"}
+        config.update((field, value) for field, value in pricing_config(row).items()
+                      if field not in HISTORY_USAGE_COLUMNS)
+        config = json.dumps(config, sort_keys=True)
+        config_id = hashlib.sha256(config.encode()).hexdigest()[:32]
+        configs[config_id] = config
+        snapshot.append((run_date, f"{aid}", row['TestId'], row['TestName'], row['TestType'], row['CreatedBy'],
+                         row['CloudAgents'], row['EnterpriseAgent'], row['Monthly_usage'], config_id))
+        for by in ROLLUP_COLUMNS:
+            rollup = rollups.setdefault((by, row[by]), [0, 0, 0, 0])
+            rollup[0] += 1
+            rollup[1] += row['Monthly_usage']
+            rollup[2] += row['CloudAgents']
+            rollup[3] += row['EnterpriseAgent']
+        yield row
+    with profile_phase("write_history"):
+        connection = open_history()
+        try:
+            with connection:
+                connection.execute("DELETE FROM usage WHERE run_date = ? AND aid = ?", (run_date, f"{aid}"))
+                connection.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", snapshot)
+                connection.executemany("INSERT OR IGNORE INTO configs VALUES (?, ?)", configs.items())
+                connection.execute("DELETE FROM rollups WHERE run_date = ? AND aid = ?", (run_date, f"{aid}"))
+                connection.executemany("INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       [(run_date, f"{aid}", by, key, *sums) for (by, key), sums in rollups.items()])
+        finally:
+            connection.close()
 
+
+def usage_trend(test_id, start=None, end=None):
+    """
+    Usage of one test in every run of the usage history
+    :param test_id:
+    :param start: first ISO date ex: 2024-01-01, None for the first run
+    :param end: last ISO date, None for the last run
+    :return: list of dicts ex: [{'run_date': '2024-10-01', 'Monthly_usage': 2120, 'CloudAgents': 9, ...}]
+    """
+    connection = open_history()
     try:
-        url = f"https://api.thousandeyes.com/v7/agents/{agent_id}"
-        payload = {}
-        headers = {"Authorization": f"Bearer {BEARER_TOKEN}", "Accept": "application/hal+json"}
-        response = requests.request('GET', url, headers=headers, data=payload)
-        response.raise_for_status()
-        resp = response.json()
-        return resp['agentName']
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        sys.exit()
-    except requests.exceptions.ConnectionError as conn_err:
-        print(f"Connection error occurred: {conn_err}")
-        sys.exit()
-    except requests.exceptions.Timeout as timeout_err:
-        print(f"Timeout error occurred: {timeout_err}")
-        sys.exit()
-    except requests.exceptions.RequestException as req_err:
-        print(f"Request error occurred: {req_err}")
-        sys.exit()
-    except Exception as err:
-        print(f"An error occurred: {err}")
-        sys.exit()
+        cursor = connection.execute(
+            "SELECT run_date, aid, monthly_usage, cloud_agents, enterprise_agents FROM usage "
+            "WHERE test_id = ? AND run_date >= ? AND run_date <= ? ORDER BY run_date",
+            (test_id, start or "", end or "9999-12-31"))
+        return [{'run_date': run_date, 'aid': aid, 'Monthly_usage': usage, 'CloudAgents': cloud,
+                 'EnterpriseAgent': enterprise}
+                for run_date, aid, usage, cloud, enterprise in cursor]
+    finally:
+        connection.close()
 
 
-def update_agent_count(te_test_dict, enterprise_agent_dict):
+def top_usage_deltas(date_from, date_to, top=10):
     """
-    Updates a dictionary with a new entry for CloudAgents and CloudAgentsList
-    :param enterprise_agent_dict:
-    :param te_test_dict:
-    :return: dict with Agent updates
+    Tests whose usage grew the most between two runs, new tests count from 0 and removed tests down to 0
+    :param date_from: ISO date of the first run
+    :param date_to: ISO date of the second run
+    :param top: number of tests
+    :return: list of dicts ex: [{'TestId': 123, 'TestName': 'Test', 'from': 1000, 'to': 3000, 'delta': 2000}, ...]
     """
-    i = 0
-    for test in te_test_dict['tests']:
-        # Check the test type
-        if test['TestType'] == 'agent-to-server' or test['TestType'] == 'agent-to-agent':
-            testtype = "network"
-        else:
-            testtype = test['TestType']
-
-        # If test is not enabled set the values to 0 and empty string
-        if not test["Enabled"]:
-            te_test_dict['tests'][i]["CloudAgents"] = 0
-            te_test_dict['tests'][i]["CloudAgentsList"] = ""
-            te_test_dict['tests'][i]["EnterpriseAgent"] = 0
-            te_test_dict['tests'][i]["EnterpriseAgentsList"] = ""
-        elif test['TestType'] == 'bgp':
-            te_test_dict['tests'][i]["CloudAgents"] = 0
-            te_test_dict['tests'][i]["CloudAgentsList"] = ""
-            te_test_dict['tests'][i]["EnterpriseAgent"] = 0
-            te_test_dict['tests'][i]["EnterpriseAgentsList"] = ""
-        else:
-            # Get test results using the test id and test type for each test
-            resp = get_te_test_result(test['TestId'], testtype)
-            # Use the test results to get the agent count for each test
-            agent = get_agent_count(resp['results'], enterprise_agent_dict)
-
-            # Update cloud agents
-            te_test_dict['tests'][i]["CloudAgents"] = agent["agent_count"]
-            if agent["agent_count"] == 0:
-                te_test_dict['tests'][i]["CloudAgentsList"] = ""
-            else:
-                te_test_dict['tests'][i]["CloudAgentsList"] = agent["agent_names"]
+    connection = open_history()
+    try:
+        cursor = connection.execute(
+            "SELECT aid, test_id, MAX(test_name), MAX(test_type), MAX(created_by), "
+            "COALESCE(SUM(CASE WHEN run_date = :from THEN monthly_usage END), 0) AS usage_from, "
+            "COALESCE(SUM(CASE WHEN run_date = :to THEN monthly_usage END), 0) AS usage_to "
+            "FROM usage WHERE run_date IN (:from, :to) GROUP BY aid, test_id "
+            "ORDER BY usage_to - usage_from DESC LIMIT :top",
+            {'from': date_from, 'to': date_to, 'top': top})
+        return [{'aid': aid, 'TestId': test_id, 'TestName': name, 'TestType': test_type, 'CreatedBy': created_by,
+                 'from': usage_from, 'to': usage_to, 'delta': usage_to - usage_from}
+                for aid, test_id, name, test_type, created_by, usage_from, usage_to in cursor]
+    finally:
+        connection.close()
 
-            # Update enterprise agents
-            te_test_dict['tests'][i]["EnterpriseAgent"] = agent["e_agent_count"]
-            if agent["e_agent_count"] == 0:
-                te_test_dict['tests'][i]["EnterpriseAgentsList"] = ""
-            else:
-                te_test_dict['tests'][i]["EnterpriseAgentsList"] = agent["e_agent_names"]
-        i += 1
-    return te_test_dict
+
+def history_pricing_configs(run_date=None, aid=None):
+    """
+    Pricing configs of every test of a run of the usage history, for what-if pricing without the API
+    :param run_date: ISO date of the run, None for the last run
+    :param aid: account group id, None for every account group
+    :return: list of pricing configs with TestId and TestName, see pricing_config and price_scenarios
+    :raises ThousandEyesError: the usage history has no run
+    """
+    connection = open_history()
+    try:
+        if run_date is None:
+            run_date = connection.execute("SELECT MAX(run_date) FROM usage").fetchone()[0]
+            if run_date is None:
+                raise ThousandEyesError(f"No run saved in the usage history {History_File}")
+        cursor = connection.execute(
+            "SELECT usage.test_id, usage.cloud_agents, usage.enterprise_agents, configs.config FROM usage "
+            "JOIN configs ON configs.config_id = usage.config_id "
+            "WHERE usage.run_date = ? AND (? IS NULL OR usage.aid = ?) ORDER BY usage.aid, usage.test_id",
+            (run_date, aid, aid))
+        configs = []
+        for test_id, cloud_agents, ent_agents, config in cursor:
+            config = json.loads(config)
+            configs.append(dict(config, TestId=test_id, CloudAgents=cloud_agents, EnterpriseAgent=ent_agents))
+        return configs
+    finally:
+        connection.close()
 
 
-def convert_to_csv(te_dict):
+def usage_rollup(by="TestType", start=None, end=None):
     """
-    Creates a filename.csv from a dict
-    :param te_dict:
-    :return: filename.csv
+    Usage of every run of the usage history summed by test type or owner
+    :param by: TestType or CreatedBy
+    :param start: first ISO date ex: 2024-01-01, None for the first run
+    :param end: last ISO date, None for the last run
+    :return: list of dicts ex: [{'run_date': '2024-10-01', 'TestType': 'http-server', 'Tests': 25,
+             'Monthly_usage': 50000, 'CloudAgents': 120, 'EnterpriseAgent': 40}, ...]
     """
+    if by not in ROLLUP_COLUMNS:
+        raise ValueError(f"usage_rollup by must be one of {', '.join(ROLLUP_COLUMNS)}")
+    connection = open_history()
+    try:
+        cursor = connection.execute(
+            "SELECT run_date, key, SUM(tests), SUM(monthly_usage), SUM(cloud_agents), SUM(enterprise_agents) "
+            "FROM rollups WHERE by_column = ? AND run_date >= ? AND run_date <= ? GROUP BY run_date, key "
+            "ORDER BY run_date, SUM(monthly_usage) DESC",
+            (by, start or "", end or "9999-12-31"))
+        return [{'run_date': run_date, by: key, 'Tests': tests, 'Monthly_usage': usage, 'CloudAgents': cloud,
+                 'EnterpriseAgent': enterprise}
+                for run_date, key, tests, usage, cloud, enterprise in cursor]
+    finally:
+        connection.close()
 
-    fieldnames = list(te_dict[0].keys())
-    with open(f'te_report_{date.today()}.csv', 'w', newline="") as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in te_dict:
-            writer.writerow(row)
-    print(f"OUTPUT saved in te_report_{date.today()}.csv file successfully")
 
+def run_report(aid, basename=None, previous_state=None, state=None, journal=None, resume_rows=None, formats=None):
+    """
+    Creates the report of one account group
+    :param aid: account group id, "" for the default account group
+    :param basename: report file name without extension, defaults to te_report_<date>
+    :param previous_state: output of load_report_state, unchanged tests reuse their agent counts
+    :param state: dict filled with the incremental mode state entry of every test, see report_state_entry
+    :param journal: open checkpoint journal, see open_journal
+    :param resume_rows: rows finished by an interrupted run, see load_journal
+    :param formats: names from REPORT_FORMATS, defaults to Report_Formats
+    :return: list of filenames, in the order of formats
+    """
+    rows = iter_account_group_rows(aid, previous_state, state, journal, resume_rows)
+    return write_report(rows, basename, formats)
 
-def round_num(num):
+
+def iter_account_group_rows(aid, previous_state=None, state=None, journal=None, resume_rows=None):
     """
-    Round the given float number to whole integer
-    :param float num:
-    :return: whole integer
+    Report pipeline of one account group, from its tests to the priced report rows
+    :param aid: account group id, "" for the default account group
+    :param previous_state: output of load_report_state, unchanged tests reuse their agent counts
+    :param state: dict filled with the incremental mode state entry of every test, see report_state_entry
+    :param journal: open checkpoint journal, see open_journal
+    :param resume_rows: rows finished by an interrupted run, see load_journal
+    :return: generator of report rows
     """
-    s_num = str(num)
-    if '.' in s_num:
-        id = s_num.split('.')
-        if int(id[1][0]) >= 5:
-            return int(id[0]) + 1
-        else:
-            return int(id[0])
+    reuse = dict(resume_rows) if resume_rows else {}
+    deadline = time.monotonic() + Fetch_Deadline if Fetch_Deadline else None
+    if Transform_Processes > 0:
+        rows = iter_transformed_rows(aid, previous_state, state, journal, reuse, scheduled=Priority_Scheduling,
+                                     deadline=deadline)
+        return iter_history(rows, aid) if History_File else rows
+    enterprise_agent_list = get_enterprise_agent_list(aid)
+    fingerprints = {}
+    tests = iter_te_tests(aid, fingerprints)
+    if previous_state:
+        tests = iter_reusable(tests, fingerprints, previous_state, reuse)
+    te_tests = {'tests': tests, 'fingerprints': fingerprints}
+    if Priority_Scheduling or deadline is not None:
+        rows = iter_scheduled_report_rows(te_tests, enterprise_agent_list, previous_state, reuse, state, journal,
+                                          deadline, aid)
     else:
-        return s_num
+        rows = iter_report_rows(te_tests, enterprise_agent_list, reuse=reuse, state=state, journal=journal, aid=aid)
+    if History_File:
+        rows = iter_history(rows, aid)
+    return rows
 
 
-def calculate_usage_manual(tests):
+def account_group_basename(account_group_name, prefix=None):
     """
-    function calculates cost for all the tests
-    :param tests:
-    :return: tests with cost calculated
+    File name without extension of the report of one account group
+    :param account_group_name:
+    :param prefix: defaults to te_report_<date>
+    :return: <prefix>_<account group>
     """
-    # Units added as per TE cost calculation page
-    Units = {
-
-        "Agent_to_Server": {"CloudAgent": 5, "EntAgent": 2.5},
-        "Agent_to_Agent": {"CloudAgent": 5, "EntAgent": 2.5},
-        "Agent_to_Agent_TE": {"EntAgent": 0.5},
-        "DNS_Server": {"CloudAgent": 5, "EntAgent": 2.5},
-        "Page_Load": {"CloudAgent": 1, "EntAgent": 0.5},
-        "DNS_Trace": {"CloudAgent": 5, "EntAgent": 2.5},
-        "HTTP_Server": {"CloudAgent": 1, "EntAgent": 0.5},
-        "FTP_Server": {"CloudAgent": 1, "EntAgent": 0.5},
-        "Voice_RTP": {"CloudAgent": 1, "EntAgent": 0.5},
-        "Voice_SIP": {"CloudAgent": 1, "EntAgent": 0.5},
-        "Web_Trans": {"CloudAgent": 1, "EntAgent": 0.5}
-    }
-    Agent_Server_Usage = 0
-    DNS_Server_Usage = 0
-    DNS_Trace_Usage = 0
-    HTTP_Server_Usage = 0
-    Page_Load_Usage = 0
-    for test in tests["tests"]:
-        TestType = test["TestType"]
-        TestName = test["TestName"]
-        TestId = test["TestId"]
-        CloudAgents = test["CloudAgents"]
-        EnterpriseAgents = test["EnterpriseAgent"]
-        if test["TeShared"] == False:
-            if test["TestType"] == "agent-to-server":
-                Interval_in_Min = test["Interval"]/60
-                Cloud_usage = (Units["Agent_to_Server"]["CloudAgent"] * (60/Interval_in_Min)*24*31 * test["CloudAgents"])/1000
-                Enterprise_usage = (Units["Agent_to_Server"]["EntAgent"] * (60/Interval_in_Min)*24*31 * test["EnterpriseAgent"])/1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                Agent_Server_Usage = Agent_Server_Usage + Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}", end='\n')
-            elif test["TestType"] == "dns-server":
-                Interval_in_Min = test["Interval"]/60
-                Cloud_usage = ((Units["DNS_Server"]["CloudAgent"]*test["servers"]) * (60/Interval_in_Min)*24*31 * test["CloudAgents"])/1000
-                Enterprise_usage = ((Units["DNS_Server"]["EntAgent"]*test["servers"]) * (60/Interval_in_Min)*24*31 * test["EnterpriseAgent"])/1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                DNS_Server_Usage = DNS_Server_Usage + Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}", end='\n')
-            elif test["TestType"] == "page-load":
-                Interval_in_Min = test["Interval"]/60
-                Cloud_usage = ((Units["Page_Load"]["CloudAgent"]*test["timeout"]) * (60/Interval_in_Min)*24*31 * test["CloudAgents"])/1000
-                Enterprise_usage = ((Units["Page_Load"]["EntAgent"]*test["timeout"]) * (60/Interval_in_Min)*24*31 * test["EnterpriseAgent"])/1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                Page_Load_Usage = Page_Load_Usage + Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}", end='\n')
-            elif test["TestType"] == "dns-trace":
-                Interval_in_Min = test["Interval"] / 60
-                Cloud_usage = (Units["DNS_Trace"]["CloudAgent"] * (60 / Interval_in_Min) * 24 * 31 * test["CloudAgents"]) / 1000
-                Enterprise_usage = (Units["DNS_Trace"]["EntAgent"] * (60 / Interval_in_Min) * 24 * 31 * test["EnterpriseAgent"]) / 1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                DNS_Trace_Usage = DNS_Trace_Usage + Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}", end='\n')
-            elif test["TestType"] == "http-server" or test["TestType"] == "api":
-                Interval_in_Min = test["Interval"] / 60
-                Cloud_usage = ((Units["HTTP_Server"]["CloudAgent"] * test["timeout"]) * (60 / Interval_in_Min) * 24 * 31 * test["CloudAgents"]) / 1000
-                Enterprise_usage = ((Units["HTTP_Server"]["EntAgent"] * test["timeout"]) * (60 / Interval_in_Min) * 24 * 31 * test["EnterpriseAgent"]) / 1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                HTTP_Server_Usage =  HTTP_Server_Usage + Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}", end='\n')
-            elif test["TestType"] == "bgp":
-                test["Monthly_usage"] = round_num(8 * (60/15 * 24 * 31)/1000)
-                Monthly_usage = test["Monthly_usage"]
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
-            elif test["TestType"] == "rtp-server":
-                Interval_in_Min = test["Interval"] / 60
-                Cloud_usage = ((Units["Voice_RTP"]["CloudAgent"] * test["duration"]) * (60 / Interval_in_Min) * 24 * 31 * test["CloudAgents"]) / 1000
-                Enterprise_usage = ((Units["Voice_RTP"]["EntAgent"] * test["duration"]) * (60 / Interval_in_Min) * 24 * 31 * test["EnterpriseAgent"]) / 1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
-            elif test["TestType"] == "sip-server":
-                Interval_in_Min = test["Interval"] / 60
-                Cloud_usage = ((Units["Voice_SIP"]["CloudAgent"] * test["timeout"]) * (60 / Interval_in_Min) * 24 * 31 * test["CloudAgents"]) / 1000
-                Enterprise_usage = ((Units["Voice_SIP"]["EntAgent"] * test["timeout"]) * (60 / Interval_in_Min) * 24 * 31 * test["EnterpriseAgent"]) / 1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
-            elif test["TestType"] == "web-transactions":
-                Interval_in_Min = test["Interval"] / 60
-                Cloud_usage = ((Units["Web_Trans"]["CloudAgent"] * test["timeout"]) * (60 / Interval_in_Min) * 24 * 31 * test["CloudAgents"]) / 1000
-                Enterprise_usage = ((Units["Web_Trans"]["EntAgent"] * test["timeout"]) * (60 / Interval_in_Min) * 24 * 31 * test["EnterpriseAgent"]) / 1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
-            elif test["TestType"] == "ftp-server":
-                Interval_in_Min = test["Interval"] / 60
-                Cloud_usage = ((Units["FTP_Server"]["CloudAgent"] * test["timeout"]) * (60 / Interval_in_Min) * 24 * 31 * test["CloudAgents"]) / 1000
-                Enterprise_usage = ((Units["FTP_Server"]["EntAgent"] * test["timeout"]) * (60 / Interval_in_Min) * 24 * 31 * test["EnterpriseAgent"]) / 1000
-                Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                HTTP_Server_Usage = HTTP_Server_Usage + Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
-            elif test["TestType"] == "agent-to-agent" and test["Throughput"] == False and test["direction"] == "bidirectional":
-                Interval_in_Min = test["Interval"] / 60
-                cloud_agents = test["CloudAgents"]
-                ent_agents = test["EnterpriseAgent"]
-                target_agent_type = get_agent_type(test['targetAgentId'])
-
-                if cloud_agents == 0:
-                    if target_agent_type == "cloud":
-                        cloud_agents = 1
-                        Cloud_usage = ((Units["Agent_to_Agent"]["CloudAgent"] * (60 / Interval_in_Min) * 24 * 31 * cloud_agents) / 1000) * ent_agents
-                        Enterprise_usage = (Units["Agent_to_Agent"]["EntAgent"] * (60 / Interval_in_Min) * 24 * 31 * ent_agents) / 1000
-                        Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                    else:
-                        Enterprise_usage = (Units["Agent_to_Agent"]["EntAgent"] * (60 / Interval_in_Min) * 24 * 31 * ent_agents) / 1000
-                        Monthly_usage = round_num((Enterprise_usage) * 2)
-
-                elif ent_agents == 0:
-                    if target_agent_type == "enterprise":
-                        ent_agents = 1
-                        Cloud_usage = (Units["Agent_to_Agent"]["CloudAgent"] * (60 / Interval_in_Min) * 24 * 31 * cloud_agents) / 1000
-                        Enterprise_usage = (Units["Agent_to_Agent"]["EntAgent"] * (60 / Interval_in_Min) * 24 * 31 * ent_agents) / 1000 * cloud_agents
-                        Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                    else:
-                        cloud_usage = (Units["Agent_to_Agent"]["CloudAgent"] * (60 / Interval_in_Min) * 24 * 31 * cloud_agents) / 1000
-                        Monthly_usage = round_num((cloud_usage) * 2)
-                else:
-                    Cloud_usage = (Units["Agent_to_Agent"]["CloudAgent"] * (60 / Interval_in_Min) * 24 * 31 * cloud_agents) / 1000
-                    Enterprise_usage = (Units["Agent_to_Agent"]["EntAgent"] * (60 / Interval_in_Min) * 24 * 31 * ent_agents) / 1000
-                    if target_agent_type == "enterprise":
-                        target_usage = ((Units["Agent_to_Agent"]["EntAgent"] * (60 / Interval_in_Min) * 24 * 31 * (cloud_agents+ent_agents)) / 1000)
-                    else:
-                        target_usage = ((Units["Agent_to_Agent"]["CloudAgent"] * (60 / Interval_in_Min) * 24 * 31 * (cloud_agents + ent_agents)) / 1000)
-                    
-                    Monthly_usage = round_num((Cloud_usage + Enterprise_usage + target_usage))
-                test["Monthly_usage"] = Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
-            elif test["TestType"] == "agent-to-agent" and test["Throughput"] == False and test["direction"] != "bidirectional":
-
-                Interval_in_Min = test["Interval"] / 60
-                cloud_agents = test["CloudAgents"]
-                ent_agents = test["EnterpriseAgent"]
-                target_agent_type = get_agent_type(test['targetAgentId'])
-              
-                if test["direction"] == "from-target":
-                    if target_agent_type == "enterprise":
-                        target_usage = ((Units["Agent_to_Agent"]["EntAgent"] * (60 / Interval_in_Min) * 24 * 31 * (cloud_agents + ent_agents)) / 1000)
-                    else:
-                        target_usage = ((Units["Agent_to_Agent"]["CloudAgent"] * (60 / Interval_in_Min) * 24 * 31 * (cloud_agents + ent_agents)) / 1000)
-                    Monthly_usage = round_num(target_usage)
-                else:
-                    Cloud_usage = (Units["Agent_to_Agent"]["CloudAgent"] * (60 / Interval_in_Min) * 24 * 31 * cloud_agents) / 1000
-                    Enterprise_usage = (Units["Agent_to_Agent"]["EntAgent"] * (60 / Interval_in_Min) * 24 * 31 * ent_agents) / 1000
-                    Monthly_usage = round_num(Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
-            elif test["TestType"] == "agent-to-agent" and test["Throughput"] == True and test["direction"] == "bidirectional":
-                Interval_in_Min = test["Interval"] / 60
-                Duration = int(test["ThroughputDuration"]) / 1000
-                Cloud_usage = 0
-                Enterprise_usage = round_num((Units["Agent_to_Agent_TE"]["EntAgent"] * Duration * (60 / Interval_in_Min) * 24 * 31 *test["EnterpriseAgent"]) * 2/ 1000)
-                Monthly_usage = (Cloud_usage + Enterprise_usage)
-                test["Monthly_usage"] = Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
-            elif test["TestType"] == "agent-to-agent" and test["Throughput"] == True and test["direction"] != "bidirectional":
-                Interval_in_Min = test["Interval"] / 60
-                Duration = int(test["ThroughputDuration"]) / 1000
-                Cloud_usage = 0
-                Enterprise_usage = round_num((Units["Agent_to_Agent_TE"]["EntAgent"] * Duration * (60 / Interval_in_Min) * 24 * 31 * test["EnterpriseAgent"]) / 1000)
-                Monthly_usage = Cloud_usage + Enterprise_usage
-                test["Monthly_usage"] = Monthly_usage
-                #print(f"{TestType=} {TestName=} {TestId=} {CloudAgents=} {EnterpriseAgents=} {Monthly_usage=}",end='\n')
+    if prefix is None:
+        prefix = f"te_report_{date.today()}"
+    return f"{prefix}_{re.sub(r'[^A-Za-z0-9._-]+', '_', account_group_name)}"
+
+
+def merge_reports(groups, filenames, filename):
+    """
+    Combines account group reports of one format into one report with an AccountGroup column
+    :param groups: account groups, see get_account_groups
+    :param filenames: report of each account group
+    :param filename: consolidated report, its extension selects the format
+    :return: filename
+    """
+    if filename.endswith(REPORT_FORMATS["parquet"][0]):
+        import pyarrow
+        import pyarrow.parquet
+        tables = []
+        for group, group_filename in zip(groups, filenames):
+            table = pyarrow.parquet.read_table(group_filename)
+            tables.append(table.add_column(0, "AccountGroup",
+                                           pyarrow.array([group['accountGroupName']] * table.num_rows,
+                                                         pyarrow.string())))
+        # Account groups without tests add no rows, their empty tables are only kept when every group is empty
+        tables = [table for table in tables if table.num_rows] or tables[:1]
+        pyarrow.parquet.write_table(pyarrow.concat_tables(tables), filename)
+    elif filename.endswith(REPORT_FORMATS["ndjson"][0]):
+        import gzip
+        with gzip.open(filename, 'wt', encoding="utf-8") as file:
+            for group, group_filename in zip(groups, filenames):
+                with gzip.open(group_filename, 'rt', encoding="utf-8") as group_file:
+                    for line in group_file:
+                        row = {'AccountGroup': group['accountGroupName']}
+                        row.update(json.loads(line))
+                        file.write(json.dumps(row) + "\n")
+    else:
+        writer = None
+        with open(filename, 'w', newline="") as file:
+            for group, group_filename in zip(groups, filenames):
+                with open(group_filename, newline="") as group_file:
+                    reader = csv.DictReader(group_file)
+                    for row in reader:
+                        if writer is None:
+                            writer = csv.DictWriter(file, fieldnames=["AccountGroup"] + reader.fieldnames)
+                            writer.writeheader()
+                        writer.writerow(dict(row, AccountGroup=group['accountGroupName']))
+    print(f"OUTPUT saved in {filename} file successfully")
+    return filename
+
+
+def run_account_group_reports(account_group_names=None, formats=None, prefix=None):
+    """
+    Creates the reports of several account groups concurrently, up to Max_Account_Groups at a time.
+    All account groups share the agent directory, the HTTP session and the Max_In_Flight request limit.
+    :param account_group_names: names of the account groups to report, None for every account group
+    :param formats: names from REPORT_FORMATS, defaults to Report_Formats
+    :param prefix: report file names start with it, defaults to te_report_<date>
+    :return: file name without extension of the consolidated reports
+    """
+    if formats is None:
+        formats = Report_Formats
+    groups = get_account_groups()
+    if account_group_names:
+        unknown = set(account_group_names) - {group['accountGroupName'] for group in groups}
+        if unknown:
+            raise ThousandEyesError(f"Unknown account groups: {', '.join(sorted(unknown))}")
+        groups = [group for group in groups if group['accountGroupName'] in account_group_names]
+
+    previous_state = load_report_state()
+    state = {}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=Max_Account_Groups) as executor:
+        futures = [executor.submit(run_report, group['aid'], account_group_basename(group['accountGroupName'], prefix),
+                                   previous_state, state, formats=formats)
+                   for group in groups]
+        filenames = [future.result() for future in futures]
+    write_report_state(state)
+    basename = f"{prefix or f'te_report_{date.today()}'}_all"
+    for i, name in enumerate(formats):
+        merge_reports(groups, [group_filenames[i] for group_filenames in filenames],
+                      f"{basename}{REPORT_FORMATS[name][0]}")
+    return basename
+
+
+# ===========================================================================================================
+
+
+def build_report_index(rows):
+    """
+    Indexes report rows by test type and owner for the daemon mode
+    :param rows: report rows
+    :return: dict ex: {'rows': [...], 'types': {'http-server': [...]}, 'owners': {'jdoe@example.com': [...]}}
+    """
+    index = {'rows': rows, 'types': {}, 'owners': {}}
+    for row in rows:
+        index['types'].setdefault(row['TestType'], []).append(row)
+        index['owners'].setdefault(row['CreatedBy'], []).append(row)
+    return index
+
+
+def refresh_report_index(aid, previous_state):
+    """
+    Rebuilds the report served by the daemon mode and replaces it at once.
+    The agent directory is reloaded; tests whose config did not change reuse their agent counts for
+    Incremental_Max_Age seconds, like the incremental mode.
+    :param aid: account group id, "" for the default account group
+    :param previous_state: state of the previous refresh, see load_report_state
+    :return: state of this refresh
+    """
+    global agent_directory, report_index
+    with agent_directory_lock:
+        agent_directory = None
+    state = {}
+    index = build_report_index(list(iter_account_group_rows(aid, previous_state, state)))
+    with report_index_lock:
+        report_index = index
+    write_report_state(state)
+    return {'tests': state}
+
+
+def filter_report(index, test_type=None, owner=None):
+    """
+    Rows of the daemon report, optionally of one test type and/or one owner
+    :param index: output of build_report_index
+    :param test_type: ex: http-server
+    :param owner: CreatedBy of the tests
+    :return: list of report rows
+    """
+    if test_type is not None:
+        rows = index['types'].get(test_type, [])
+        if owner is not None:
+            rows = [row for row in rows if row['CreatedBy'] == owner]
+        return rows
+    if owner is not None:
+        return index['owners'].get(owner, [])
+    return index['rows']
+
+
+def report_csv(rows):
+    """
+    Formats report rows as CSV text, like convert_to_csv
+    :param rows: report rows
+    :return: str
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(rows[0].keys() if rows else REPORT_COLUMNS)
+    for row in rows:
+        writer.writerow(row.values())
+    return output.getvalue()
+
+
+def report_request_handler():
+    """
+    Creates the request handler of the daemon mode, http.server is only imported by the daemon mode
+    :return: BaseHTTPRequestHandler class
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class ReportRequestHandler(BaseHTTPRequestHandler):
+        """
+        Serves the daemon report:
+        /report.csv and /report.json, filtered with ?type=<test type> and/or ?owner=<created by>, and /status
+        """
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = {name: values[0] for name, values in parse_qs(url.query).items()}
+            with report_index_lock:
+                index = report_index
+                status = dict(daemon_status)
+            if url.path == "/status":
+                status['tests'] = len(index['rows']) if index is not None else None
+                status['concurrency_limit'] = test_result_limiter.limit if test_result_limiter is not None else None
+                self.send_body(200, "application/json", json.dumps(status))
+            elif url.path not in ("/report.csv", "/report.json"):
+                self.send_body(404, "application/json", json.dumps({'error': "not found"}))
+            elif index is None:
+                self.send_body(503, "application/json", json.dumps({'error': "the first report is not ready yet"}))
             else:
-                test["Monthly_usage"] = 0
-            del test["servers"]
-            del test["timeout"]
-            del test["duration"]
-            del test["Throughput"]
-            del test["direction"]
-            del test["ThroughputDuration"]
-            del test["targetAgentId"]
+                rows = filter_report(index, params.get("type"), params.get("owner"))
+                if url.path == "/report.csv":
+                    self.send_body(200, "text/csv", report_csv(rows))
+                else:
+                    self.send_body(200, "application/json", json.dumps([report_columns(row) for row in rows]))
+
+        def send_body(self, status, content_type, text):
+            data = text.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return ReportRequestHandler
+
+
+def refresh_reports(aid, interval, stop):
+    """
+    Refreshes the daemon report every interval seconds until stop is set.
+    A failed refresh keeps the previous report and is retried at the next interval.
+    :param aid: account group id, "" for the default account group
+    :param interval: seconds between the start of two refreshes
+    :param stop: threading.Event
+    """
+    previous_state = load_report_state()
+    while True:
+        start = time.time()
+        reset_coalesced_requests()
+        try:
+            previous_state = refresh_report_index(aid, previous_state)
+            error = None
+        except ThousandEyesError as err:
+            print(f"Report refresh failed: {err}")
+            error = f"{err}"
+        except Exception as err:
+            # Any other failure, ex: an unexpected payload or a history database error, must not stop the refreshes
+            print(f"Report refresh failed: {err!r}")
+            error = f"{err!r}"
+        with report_index_lock:
+            daemon_status.update(refreshed=time.time(), seconds=time.time() - start, error=error)
+        if stop.wait(max(interval - (time.time() - start), 0)):
+            return
+
+
+def run_daemon(aid, host=None, port=None, interval=None):
+    """
+    Daemon mode: keeps the report in memory, refreshes it every interval seconds and serves it over HTTP
+    :param aid: account group id, "" for the default account group
+    :param host: defaults to Daemon_Host
+    :param port: defaults to Daemon_Port
+    :param interval: seconds between two refreshes, defaults to Refresh_Interval
+    """
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host or Daemon_Host, port or Daemon_Port), report_request_handler())
+    server.daemon_threads = True
+    stop = threading.Event()
+    threading.Thread(target=refresh_reports, args=(aid, interval or Refresh_Interval, stop), daemon=True).start()
+    print(f"Serving the report on http://{server.server_address[0]}:{server.server_address[1]}/report.csv")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+
+def parse_scenario_values(text):
+    """
+    Parses a --set argument of the price command
+    :param text: FIELD=VALUE[,VALUE...] ex: Interval=300,900
+    :return: (field, list of values), numbers as int and true/false as bool
+    """
+    field, _, values = text.partition("=")
+    if field not in PRICING_FIELDS or not values:
+        raise argparse.ArgumentTypeError(f"expected FIELD=VALUE[,VALUE...] with FIELD one of {', '.join(PRICING_FIELDS)}")
+    parsed = []
+    for value in values.split(","):
+        if value.lstrip("-").isdigit():
+            parsed.append(int(value))
+        elif value.lower() in ("true", "false"):
+            parsed.append(value.lower() == "true")
         else:
-            test["Monthly_usage"] = 0
-            del test["servers"]
-            del test["timeout"]
-            del test["duration"]
-            del test["Throughput"]
-            del test["direction"]
-            del test["ThroughputDuration"]
-            del test["targetAgentId"]
-    #print(f"{Agent_Server_Usage=} {DNS_Server_Usage=} {DNS_Trace_Usage=} {Page_Load_Usage=} {HTTP_Server_Usage=}")
-    return tests
+            parsed.append(value)
+    return field, parsed
 
-# ===========================================================================================================
+
+def price_command(args):
+    """
+    price command: what-if usage of the tests of a usage history run, no API request
+    :param args: parsed arguments
+    """
+    configs = history_pricing_configs(args.date)
+    values = dict(args.set or [])
+    scenarios = [{}] + (scenario_grid(**values) if values else [])
+    for result in price_scenarios(configs, scenarios, args.test_types):
+        name = ", ".join(f"{field}={value}" for field, value in result['scenario'].items()) or "current"
+        print(f"{name:<50}{result['Monthly_usage']:>14}")
+
+
+def main(argv=None):
+    """
+    Command line entry point, see python3 main.py --help
+    Networking, NumPy and the .env file are only loaded by the commands that need them.
+    :param argv: arguments, defaults to sys.argv[1:]
+    """
+    global Account_Group_Name, Max_Workers, Max_In_Flight, Adaptive_Concurrency, Transform_Processes, Record_File
+    global History_File, Priority_Scheduling, Fetch_Deadline, Incremental_State_File
+    parser = argparse.ArgumentParser(description="ThousandEyes test report")
+    parser.add_argument("--account-group", metavar="NAME", default=Account_Group_Name,
+                        help="account group to report, default: the default account group of the token")
+    parser.add_argument("--output", metavar="BASENAME",
+                        help="report file name without extension, default: te_report_<date>")
+    parser.add_argument("--format", nargs="+", choices=sorted(REPORT_FORMATS), default=list(Report_Formats),
+                        help="output formats written from the same rows, default: %(default)s")
+    parser.add_argument("--workers", type=int, default=Max_Workers,
+                        help="test results fetched concurrently, where the adaptive concurrency starts, "
+                             "default: %(default)s")
+    parser.add_argument("--fixed-workers", action="store_true", default=not Adaptive_Concurrency,
+                        help="always fetch --workers test results concurrently instead of adapting to the API")
+    parser.add_argument("--max-in-flight", type=int, default=Max_In_Flight,
+                        help="API requests in flight across all account groups, default: %(default)s")
+    parser.add_argument("--transform-processes", type=int, metavar="N", default=Transform_Processes,
+                        help="processes decoding, counting and pricing the test results, 0 for none, "
+                             "default: %(default)s")
+    parser.add_argument("--state", metavar="FILE", default=Incremental_State_File or None,
+                        help="json file of the incremental mode: tests that did not change reuse the agent counts "
+                             "of the previous run")
+    parser.add_argument("--priority", action="store_true", default=Priority_Scheduling,
+                        help="fetch the test results of new, changed and expensive tests first")
+    parser.add_argument("--deadline", type=float, metavar="SECONDS", default=Fetch_Deadline,
+                        help="stop fetching test results after SECONDS per account group, tests not fetched keep "
+                             "the agent counts of the --state file and are marked CarriedOver, 0 for none")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run, tests in the checkpoint journal are not fetched again")
+    parser.add_argument("--all-account-groups", action="store_true",
+                        help="report every account group, one CSV per account group plus a consolidated CSV")
+    parser.add_argument("--account-groups", nargs="+", metavar="NAME",
+                        help="report these account groups, one CSV per account group plus a consolidated CSV")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the run profile summary, it is always saved next to the CSV")
+    parser.add_argument("--history", metavar="FILE", default=History_File or None,
+                        help="sqlite usage history every run is saved to, see the price command")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep the report in memory, refresh it every --interval seconds and serve it over HTTP")
+    parser.add_argument("--port", type=int, default=Daemon_Port, help="HTTP port of --daemon, default: %(default)s")
+    parser.add_argument("--interval", type=int, default=Refresh_Interval,
+                        help="seconds between two refreshes of --daemon, default: %(default)s")
+    parser.add_argument("--record", metavar="FIXTURES",
+                        help="append every API response to this jsonl file, replay it with benchmark.py replay")
+    commands = parser.add_subparsers(dest="command", metavar="{price}")
+    price = commands.add_parser("price", help="what-if usage of a usage history run, without API requests")
+    price.add_argument("--date", help="ISO date of the history run, default: the last run")
+    price.add_argument("--test-types", nargs="+", metavar="TYPE", help="test types --set applies to, default: all")
+    price.add_argument("--set", action="append", type=parse_scenario_values, metavar="FIELD=VALUE[,VALUE...]",
+                       help="pricing field values to try, every combination is priced ex: --set Interval=300,900")
+    args = parser.parse_args(argv)
+
+    Account_Group_Name = args.account_group
+    Max_Workers = args.workers
+    Max_In_Flight = args.max_in_flight
+    Adaptive_Concurrency = not args.fixed_workers
+    Transform_Processes = args.transform_processes
+    Priority_Scheduling = args.priority
+    Fetch_Deadline = args.deadline
+    if args.record:
+        Record_File = args.record
+    if args.history:
+        History_File = args.history
+    if args.state:
+        Incremental_State_File = args.state
+    if Fetch_Deadline and not Incremental_State_File:
+        parser.error("--deadline needs the agent counts of a previous run, see --state")
+    reset_run_profile()
+    reset_coalesced_requests()
+    try:
+        if args.command == "price":
+            if not History_File:
+                parser.error("the price command needs a usage history, see --history")
+            if not os.path.exists(History_File):
+                parser.error(f"usage history {History_File} not found")
+            price_command(args)
+            return
+
+        if args.all_account_groups or args.account_groups:
+            basename = run_account_group_reports(args.account_groups, args.format, args.output)
+            write_run_profile(basename)
+            if args.profile:
+                print_run_profile()
+            return
+
+        if Account_Group_Name != "":
+            AID = get_account_id(Account_Group_Name)
+        else:
+            AID = ""
+        if args.daemon:
+            run_daemon(AID, port=args.port, interval=args.interval)
+            return
+        state = {}
+        resume_rows = load_journal(AID) if args.resume else None
+        basename = args.output or f'te_report_{date.today()}'
+        with open_journal(AID, args.resume) as journal:
+            run_report(AID, basename, previous_state=load_report_state(), state=state, journal=journal,
+                       resume_rows=resume_rows, formats=args.format)
+        write_report_state(state)
+        os.remove(Journal_File)
+        write_run_profile(basename)
+        if args.profile:
+            print_run_profile()
+    except ThousandEyesError as err:
+        print(err)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    if Account_Group_Name != "":
-        AID = get_account_id(Account_Group_Name)
-    else:
-        AID = ""
-    te_tests = get_te_tests(AID)
-    enterprise_agent_list = get_enterprise_agent_list()
-    te_updated_tests = update_agent_count(te_tests, enterprise_agent_list)
-    te_updated_tests = calculate_usage_manual(te_updated_tests)
-    convert_to_csv(te_updated_tests["tests"])
+    main()
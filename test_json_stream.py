@@ -0,0 +1,221 @@
+"""
+Copyright (c) 2024 Cisco and/or its affiliates.
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+               https://developer.cisco.com/docs/licenses
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# The streaming json decoder must decode a response the same wherever the network splits it into chunks,
+# and a streamed response must keep its in-flight slot until its body is closed.
+# Usage: python3 -m pytest test_json_stream.py
+
+import json
+import random
+import threading
+
+import pytest
+import requests
+
+import main
+
+
+def decode(chunks, items_key="results"):
+    """
+    Runs iter_json_items to the end
+    :param chunks: list of bytes
+    :param items_key:
+    :return: (list of items, dict of the other members)
+    """
+    items = []
+    decoder = main.iter_json_items(iter(chunks), items_key)
+    while True:
+        try:
+            items.append(next(decoder))
+        except StopIteration as stop:
+            return items, stop.value
+
+
+def split(data, positions):
+    """
+    Splits bytes at the given positions
+    :return: list of bytes
+    """
+    bounds = [0] + sorted(positions) + [len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def expected(document, items_key="results"):
+    rest = dict(document)
+    return rest.pop(items_key, []), rest
+
+
+def random_value(rnd, depth=0):
+    """
+    Random json value with numbers, escapes and multi-byte characters
+    """
+    kind = rnd.randrange(8 if depth < 3 else 5)
+    if kind == 0:
+        return rnd.randint(-10 ** 6, 10 ** 6)
+    if kind == 1:
+        return rnd.choice([1.5e-7, -2.25e30, 3.5, 0.0, 1e100, rnd.uniform(-1000, 1000)])
+    if kind == 2:
+        return "".join(rnd.choice(["a", "é", "東", "😀", '"', "\\", "\n", "\u0001", " "])
+                       for _ in range(rnd.randint(0, 8)))
+    if kind == 3:
+        return rnd.choice([True, False, None])
+    if kind == 4:
+        return f"agent {rnd.randint(1, 99)}"
+    if kind == 5:
+        return [random_value(rnd, depth + 1) for _ in range(rnd.randint(0, 4))]
+    return {f"k{i}é": random_value(rnd, depth + 1) for i in range(rnd.randint(0, 4))}
+
+
+@pytest.mark.parametrize("chunks, items, rest", [
+    # Numbers cut before their fraction or exponent
+    ([b'{"results": [1.5e', b'3]}'], [1500.0], {}),
+    ([b'{"total": 3.', b'5, "results": []}'], [], {"total": 3.5}),
+    ([b'{"results": [1', b'2, -', b'3.0E', b'+2, 7', b'e-1]}'], [12, -300.0, 0.7], {}),
+    # Multi-byte characters and escapes cut inside strings
+    ([b'{"results": ["\xe6', b'\x9d\xb1", "\xf0\x9f', b'\x98\x80"]}'], ["東", "😀"], {}),
+    ([b'{"results": ["a\\', b'"b", "\\u00', b'e9", "\\', b'n"]}'], ['a"b', "é", "\n"], {}),
+    # Literals cut in the middle
+    ([b'{"results": [tr', b'ue, nu', b'll, f', b'alse]}'], [True, None, False], {}),
+    # Empty and missing item arrays
+    ([b'{"results": []}'], [], {}),
+    ([b'{"results":', b' [ ', b'] , "total": 0}'], [], {"total": 0}),
+    ([b'{"total": 2, "_links": {"next": {"href": "/v7/tests?cursor=2"}}}'], [],
+     {"total": 2, "_links": {"next": {"href": "/v7/tests?cursor=2"}}}),
+    ([b'{}'], [], {}),
+    ([b' {  ', b'}'], [], {}),
+    # An items key that is not an array is another member
+    ([b'{"results": null}'], [], {"results": None}),
+])
+def test_chunk_boundaries(chunks, items, rest):
+    assert decode(chunks) == (items, rest)
+
+
+def test_every_split_of_a_document():
+    document = {"total": 3.5, "x": -12e-3, "name": "Agent \"São Paulo\" 東京 😀\\",
+                "results": [1.5e30, -0.25, 10, {"a": 1e5, "b": [True, None, 7]}, "sé\u0001"], "n": 0}
+    data = json.dumps(document, ensure_ascii=False).encode()
+    for i in range(len(data) + 1):
+        for j in range(i, len(data) + 1, 3):
+            assert decode(split(data, [i, j])) == expected(document)
+
+
+def test_random_documents_in_random_chunks():
+    rnd = random.Random(1)
+    for _ in range(1500):
+        document = {f"m{i}": random_value(rnd) for i in range(rnd.randint(0, 3))}
+        if rnd.random() < 0.9:
+            document["results"] = [random_value(rnd) for _ in range(rnd.randint(0, 12))]
+        data = json.dumps(document, ensure_ascii=rnd.random() < 0.5, indent=rnd.choice([None, 1])).encode()
+        positions = [rnd.randint(0, len(data)) for _ in range(rnd.randint(0, 12))]
+        assert decode(split(data, positions)) == expected(document)
+
+
+@pytest.mark.parametrize("chunks", [
+    [],
+    [b''],
+    [b'{"results": [1, 2'],
+    [b'{"results": [1, 2]'],
+    [b'{"results": ["abc'],
+    [b'{"total": 3.', b''],
+    [b'{"results"'],
+    [b'{"results": [1', b' 2]}'],
+    [b'[1, 2]'],
+])
+def test_invalid_or_truncated_input(chunks):
+    with pytest.raises(main.ThousandEyesError):
+        decode(chunks)
+
+
+class FakeResponse:
+    """
+    Streamed response of the fake session, its body is sent in chunks
+    """
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.headers = {}
+        self.body = body
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), 4):
+            yield self.body[start:start + 4]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.responses = []
+
+    def get(self, url, **kwargs):
+        self.responses.append(FakeResponse(self.status_code, self.body))
+        return self.responses[-1]
+
+
+@pytest.fixture
+def in_flight(monkeypatch):
+    semaphore = threading.BoundedSemaphore(2)
+    monkeypatch.setattr(main, "in_flight_requests", semaphore)
+    monkeypatch.setattr(main, "BEARER_TOKEN", "token")
+    monkeypatch.setattr(main, "Record_File", "")
+    monkeypatch.setattr(main, "response_cache", None)
+    monkeypatch.setattr(main, "Cache_File", "")
+    return semaphore
+
+
+def free_slots(semaphore):
+    return semaphore._value
+
+
+def test_streamed_response_holds_its_slot_until_read(in_flight, monkeypatch):
+    session = FakeSession(200, b'{"results": [1, 2, 3], "total": 3}')
+    monkeypatch.setattr(main, "get_session", lambda: session)
+    items = main.api_get_items("/v7/test-results/1/http-server", "results")
+    assert next(items) == 1
+    assert free_slots(in_flight) == 1
+    assert list(items) == [2, 3]
+    assert free_slots(in_flight) == 2
+    assert session.responses[0].closed
+
+
+def test_closed_stream_releases_its_slot(in_flight, monkeypatch):
+    session = FakeSession(200, b'{"results": [1, 2, 3]}')
+    monkeypatch.setattr(main, "get_session", lambda: session)
+    items = main.api_get_items("/v7/test-results/1/http-server", "results")
+    next(items)
+    items.close()
+    assert free_slots(in_flight) == 2
+    assert session.responses[0].closed
+
+
+def test_failed_stream_releases_its_slot(in_flight, monkeypatch):
+    monkeypatch.setattr(main, "get_session", lambda: FakeSession(200, b'{"results": [1, 2'))
+    with pytest.raises(main.ThousandEyesError):
+        list(main.api_get_items("/v7/test-results/1/http-server", "results"))
+    assert free_slots(in_flight) == 2
+
+    session = FakeSession(404, b'{}')
+    monkeypatch.setattr(main, "get_session", lambda: session)
+    with pytest.raises(main.ThousandEyesHTTPError):
+        list(main.api_get_items("/v7/test-results/1/http-server", "results"))
+    assert free_slots(in_flight) == 2
+    assert session.responses[0].closed
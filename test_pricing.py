@@ -0,0 +1,192 @@
+"""
+Copyright (c) 2024 Cisco and/or its affiliates.
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+               https://developer.cisco.com/docs/licenses
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# The vectorized pricing must give exactly the Monthly_usage of the original per-test if/elif rules.
+# Usage: python3 -m pytest test_pricing.py
+
+import random
+
+import pytest
+
+import main
+
+# Units of the original calculate_usage_manual
+REFERENCE_UNITS = {
+    "Agent_to_Server": {"CloudAgent": 5, "EntAgent": 2.5},
+    "Agent_to_Agent": {"CloudAgent": 5, "EntAgent": 2.5},
+    "Agent_to_Agent_TE": {"EntAgent": 0.5},
+    "DNS_Server": {"CloudAgent": 5, "EntAgent": 2.5},
+    "Page_Load": {"CloudAgent": 1, "EntAgent": 0.5},
+    "DNS_Trace": {"CloudAgent": 5, "EntAgent": 2.5},
+    "HTTP_Server": {"CloudAgent": 1, "EntAgent": 0.5},
+    "FTP_Server": {"CloudAgent": 1, "EntAgent": 0.5},
+    "Voice_RTP": {"CloudAgent": 1, "EntAgent": 0.5},
+    "Voice_SIP": {"CloudAgent": 1, "EntAgent": 0.5},
+    "Web_Trans": {"CloudAgent": 1, "EntAgent": 0.5},
+}
+
+# Test type -> (unit, multiplier field or None) of the original rules, agent-to-agent and bgp have their own
+REFERENCE_TYPES = {
+    "agent-to-server": ("Agent_to_Server", None),
+    "dns-server": ("DNS_Server", "servers"),
+    "page-load": ("Page_Load", "timeout"),
+    "dns-trace": ("DNS_Trace", None),
+    "http-server": ("HTTP_Server", "timeout"),
+    "api": ("HTTP_Server", "timeout"),
+    "rtp-server": ("Voice_RTP", "duration"),
+    "sip-server": ("Voice_SIP", "timeout"),
+    "web-transactions": ("Web_Trans", "timeout"),
+    "ftp-server": ("FTP_Server", "timeout"),
+}
+
+# Target agent ids of the agent directory used by the tests, by agent type
+TARGET_AGENTS = {101: "cloud", 102: "enterprise", 103: "enterprise-cluster"}
+
+
+def reference_usage(test, target_type):
+    """
+    Monthly_usage of one test with the original if/elif rules, in the same floating point operation order
+    :param test: test dict with the pricing fields
+    :param target_type: type of the target agent of agent-to-agent tests
+    :return: Monthly_usage
+    """
+    if test["TeShared"] != False:
+        return 0
+    runs = 60 / (test["Interval"] / 60)
+    cloud_agents = test["CloudAgents"]
+    ent_agents = test["EnterpriseAgent"]
+
+    def units(unit, agents, multiplier=1):
+        return (unit * multiplier * runs * 24 * 31 * agents) / 1000
+
+    if test["TestType"] in REFERENCE_TYPES:
+        name, field = REFERENCE_TYPES[test["TestType"]]
+        multiplier = test[field] if field else 1
+        return main.round_num(units(REFERENCE_UNITS[name]["CloudAgent"], cloud_agents, multiplier)
+                              + units(REFERENCE_UNITS[name]["EntAgent"], ent_agents, multiplier))
+    if test["TestType"] == "bgp":
+        return main.round_num(8 * (60/15 * 24 * 31)/1000)
+    if test["TestType"] != "agent-to-agent":
+        return 0
+
+    cloud_unit = REFERENCE_UNITS["Agent_to_Agent"]["CloudAgent"]
+    ent_unit = REFERENCE_UNITS["Agent_to_Agent"]["EntAgent"]
+    target_unit = ent_unit if target_type == "enterprise" else cloud_unit
+    if test["Throughput"] == False and test["direction"] == "bidirectional":
+        if cloud_agents == 0:
+            if target_type == "cloud":
+                return main.round_num(units(cloud_unit, 1) * ent_agents + units(ent_unit, ent_agents))
+            return main.round_num(units(ent_unit, ent_agents) * 2)
+        if ent_agents == 0:
+            if target_type == "enterprise":
+                return main.round_num(units(cloud_unit, cloud_agents) + units(ent_unit, 1) * cloud_agents)
+            return main.round_num(units(cloud_unit, cloud_agents) * 2)
+        return main.round_num(units(cloud_unit, cloud_agents) + units(ent_unit, ent_agents)
+                              + units(target_unit, cloud_agents + ent_agents))
+    if test["Throughput"] == False:
+        if test["direction"] == "from-target":
+            return main.round_num(units(target_unit, cloud_agents + ent_agents))
+        return main.round_num(units(cloud_unit, cloud_agents) + units(ent_unit, ent_agents))
+    if test["Throughput"] == True:
+        duration = int(test["ThroughputDuration"]) / 1000
+        ent_usage = REFERENCE_UNITS["Agent_to_Agent_TE"]["EntAgent"] * duration * runs * 24 * 31 * ent_agents
+        if test["direction"] == "bidirectional":
+            return 0 + main.round_num(ent_usage * 2 / 1000)
+        return 0 + main.round_num(ent_usage / 1000)
+    return 0
+
+
+def random_test(rnd, test_id):
+    """
+    Random test dict with agent counts and every pricing field
+    :param rnd: random.Random
+    :param test_id:
+    :return: test dict
+    """
+    return {"TestId": f"{test_id}", "TestName": f"Test {test_id}",
+            "TestType": rnd.choice(list(REFERENCE_TYPES) + ["bgp", "agent-to-agent", "agent-to-agent", "voice"]),
+            "TeShared": rnd.random() < 0.1,
+            "Interval": rnd.choice([60, 120, 300, 600, 900, 1800, 3600, 7, 45, 3599]),
+            "CloudAgents": rnd.choice([0, 0, 1, 2, 3, 5, 8, 13, 40]),
+            "EnterpriseAgent": rnd.choice([0, 0, 1, 2, 4, 7, 25]),
+            "servers": rnd.randint(1, 5), "timeout": rnd.randint(1, 60), "duration": rnd.randint(5, 30),
+            "Throughput": rnd.choice([True, False, False, "NotApplicable"]),
+            "direction": rnd.choice(["bidirectional", "to-target", "from-target"]),
+            "ThroughputDuration": rnd.choice([1000, 5000, 10000, 15000, 20000]),
+            "targetAgentId": rnd.choice(list(TARGET_AGENTS) + [999])}
+
+
+def random_batches(seed, count, size):
+    """
+    Random batches of tests, with the Monthly_usage of each test under the original rules
+    :return: list of (tests, expected Monthly_usage values)
+    """
+    rnd = random.Random(seed)
+    batches = []
+    for _ in range(count):
+        tests = [random_test(rnd, i) for i in range(rnd.randint(1, size))]
+        batches.append((tests, [reference_usage(test, TARGET_AGENTS.get(test["targetAgentId"], "NotApplicable"))
+                                for test in tests]))
+    return batches
+
+
+@pytest.fixture(autouse=True)
+def agent_directory(monkeypatch):
+    monkeypatch.setattr(main, "agent_directory", {"names": {}, "types": dict(TARGET_AGENTS), "enterprise": set(),
+                                                  "account_groups": {""}})
+
+
+@pytest.mark.parametrize("test, expected", [
+    # 5 * 12 runs * 744 hours * 2 / 1000 + 2.5 * 12 * 744 * 1 / 1000 = 111.6
+    ({"TestType": "agent-to-server", "Interval": 300, "CloudAgents": 2, "EnterpriseAgent": 1}, 112),
+    # 1 * 30 timeout * 60 runs * 744 hours * 3 / 1000 = 4017.6
+    ({"TestType": "http-server", "Interval": 60, "CloudAgents": 3, "EnterpriseAgent": 0, "timeout": 30}, 4018),
+    ({"TestType": "bgp", "Interval": 900, "CloudAgents": 0, "EnterpriseAgent": 0}, 24),
+    ({"TestType": "http-server", "TeShared": True, "Interval": 60, "CloudAgents": 3, "EnterpriseAgent": 0,
+      "timeout": 30}, 0),
+])
+def test_golden_values(test, expected):
+    test = dict({"TeShared": False}, **test)
+    assert reference_usage(test, "NotApplicable") == expected
+    assert main.calculate_monthly_usage([test]) == [expected]
+    assert main.price_tests([test]) == [expected]
+
+
+def test_calculate_monthly_usage_matches_original_rules():
+    for tests, expected in random_batches(seed=1, count=2000, size=40):
+        assert main.calculate_monthly_usage(tests) == expected
+
+
+def test_calculate_usage_manual_matches_original_rules():
+    for tests, expected in random_batches(seed=2, count=300, size=40):
+        priced = main.calculate_usage_manual({'tests': [dict(test) for test in tests]})['tests']
+        assert [test["Monthly_usage"] for test in priced] == expected
+        assert not any(key in test for test in priced for key in main.PRICING_KEYS)
+
+
+def test_price_tests_matches_original_rules():
+    memo = {}
+    for tests, expected in random_batches(seed=3, count=1000, size=40):
+        configs = [main.pricing_config(test) for test in tests]
+        assert main.price_tests(configs) == expected
+        assert main.price_tests(configs, memo) == expected
+        assert main.price_scenarios(configs, [{}], memo=memo)[0]['tests'] == expected
+
+
+def test_round_usage_matches_round_num():
+    import numpy as np
+    rnd = random.Random(4)
+    values = [0.0, 0.5, 1.5, 2.4999999, 1e-05, 3e-07, 1e16, 2.5e17, 123456789.95] + \
+             [rnd.uniform(0, 10 ** rnd.randint(0, 12)) for _ in range(5000)]
+    assert main.round_usage(np.array(values)) == [main.round_num(value) for value in values]